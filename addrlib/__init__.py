@@ -7,17 +7,78 @@
 # Addrlib
 # A Python/Cython Address Library for Wii U textures.
 
+from . import addrlib as addrlib_py
+
 try:
     import pyximport
     pyximport.install()
 
-    from . import addrlib_cy as addrlib
+    from . import addrlib_cy
 
 except:
-    from . import addrlib
+    addrlib_cy = None
+
+try:
+    from . import addrlib_np
+
+except ImportError:
+    addrlib_np = None
+
+# The modules that can be used for (de)swizzling, in order of preference.
+# NumPy comes before Cython: the layouts use the same few surface sizes,
+# so its cached swizzle tables turn most calls into a single gather
+# instead of computing the address of every pixel again.
+backends = {}
+
+if addrlib_np is not None:
+    backends['numpy'] = addrlib_np
+
+if addrlib_cy is not None:
+    backends['cython'] = addrlib_cy
+
+backends['python'] = addrlib_py
+
+addrlib = addrlib_py if addrlib_cy is None else addrlib_cy
+
+
+def useBackend(name):
+    """
+    Select the module used for (de)swizzling: 'cython', 'numpy' or 'python'
+    """
+    global backend, deswizzle, swizzle
+
+    module = backends[name]
+
+    backend = name
+    deswizzle = module.deswizzle
+    swizzle = module.swizzle
+
+
+def cacheInfo():
+    """
+    Get the counters of the swizzle table cache of the NumPy backend,
+    or None if it isn't available
+    """
+    if addrlib_np is None:
+        return None
+
+    return addrlib_np.cacheInfo()
+
+
+def getTableCache():
+    """
+    Get the swizzle table cache of the NumPy backend, or None if it isn't available
+    """
+    if addrlib_np is None:
+        return None
+
+    return addrlib_np.tableCache
+
 
 # Define the functions that can be used
-deswizzle = addrlib.deswizzle
-swizzle = addrlib.swizzle
+useBackend(next(iter(backends)))
 surfaceGetBitsPerPixel = addrlib.surfaceGetBitsPerPixel
-getSurfaceInfo = addrlib.getSurfaceInfo
+
+# The Python version is reentrant and memoized,
+# so it's used even if the Cython module is available
+getSurfaceInfo = addrlib_py.getSurfaceInfo
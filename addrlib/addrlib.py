@@ -8,6 +8,9 @@
 ################################################################
 ################################################################
 
+from collections import namedtuple
+from functools import lru_cache
+
 BCn_formats = [
     0x31, 0x431, 0x32, 0x432,
     0x33, 0x433, 0x34, 0x234,
@@ -226,7 +229,16 @@ def computeSurfaceAddrFromCoordMicroTiled(x, y, bpp, pitch, tileMode):
     return pixelOffset + microTileOffset
 
 
-bankSwapOrder = [0, 1, 3, 2, 6, 7, 5, 4, 0, 0]
+bankSwapOrder = (0, 1, 3, 2, 6, 7, 5, 4, 0, 0)
+
+
+def getBankSwap(swapIndex):
+    """
+    Get bankSwapOrder[swapIndex & 3]. The first four entries are the Gray code
+    of the index, so this also works on the NumPy arrays of addrlib_np.
+    """
+    swapIndex = swapIndex & 3
+    return swapIndex ^ (swapIndex >> 1)
 
 
 def computeSurfaceAddrFromCoordMacroTiled(x, y, bpp, pitch, height,
@@ -289,17 +301,12 @@ def computeSurfaceAddrFromCoordMacroTiled(x, y, bpp, pitch, height,
     if tileMode in [8, 9, 10, 11, 14, 15]:
         bankSwapWidth = computeSurfaceBankSwappedWidth(tileMode, bpp, pitch, 1)
         swapIndex = macroTilePitch * macroTileIndexX // bankSwapWidth
-        bank ^= bankSwapOrder[swapIndex & 3]
+        bank ^= getBankSwap(swapIndex)
 
     totalOffset = elemOffset + ((macroTileOffset + sliceOffset) >> 3)
     return bank << 9 | pipe << 8 | 255 & totalOffset | (totalOffset & -256) << 3
 
 
-expPitch = 0
-expHeight = 0
-expNumSlices = 0
-
-
 class Flags:
     def __init__(self):
         self.value = 0
@@ -358,8 +365,13 @@ class surfaceOut:
         self.tileIndex = 0
 
 
-pIn = surfaceIn()
-pOut = surfaceOut()
+# The immutable result of getSurfaceInfo()
+SurfaceInfo = namedtuple('SurfaceInfo', [
+    'size', 'pitch', 'height', 'depth', 'surfSize', 'tileMode',
+    'baseAlign', 'pitchAlign', 'heightAlign', 'depthAlign', 'bpp',
+    'pixelPitch', 'pixelHeight', 'pixelBits', 'sliceSize',
+    'pitchTileMax', 'heightTileMax', 'sliceTileMax', 'tileType', 'tileIndex',
+])
 
 
 def powTwoAlign(x, align):
@@ -384,7 +396,7 @@ def getBitsPerPixel(format_):
             formatExInfo[fmtIdx + 2], formatExInfo[fmtIdx + 3])
 
 
-def adjustSurfaceInfo(elemMode, expandX, expandY, bpp, width, height):
+def adjustSurfaceInfo(pIn, elemMode, expandX, expandY, bpp, width, height):
     bBCnFormat = 0
     if bpp and elemMode in [9, 10, 11, 12, 13]:
         bBCnFormat = 1
@@ -433,7 +445,7 @@ def adjustSurfaceInfo(elemMode, expandX, expandY, bpp, width, height):
     return 0
 
 
-def hwlComputeMipLevel():
+def hwlComputeMipLevel(pIn):
     handled = 0
 
     if 49 <= pIn.format <= 55:
@@ -462,7 +474,7 @@ def hwlComputeMipLevel():
     return handled
 
 
-def computeMipLevel():
+def computeMipLevel(pIn):
     slices = 0
     height = 0
     width = 0
@@ -472,7 +484,7 @@ def computeMipLevel():
         pIn.width = powTwoAlign(pIn.width, 4)
         pIn.height = powTwoAlign(pIn.height, 4)
 
-    hwlHandled = hwlComputeMipLevel()
+    hwlHandled = hwlComputeMipLevel(pIn)
     if not hwlHandled and pIn.mipLevel and (pIn.flags.value >> 12) & 1:
         width = max(1, pIn.width >> pIn.mipLevel)
         height = max(1, pIn.height >> pIn.mipLevel)
@@ -625,11 +637,8 @@ def computeSurfaceMipLevelTileMode(baseTileMode, bpp, level, width, height, numS
     return expTileMode
 
 
-def padDimensions(tileMode, padDims, isCube, cubeAsArray, pitchAlign, heightAlign, sliceAlign):
-    global expPitch
-    global expHeight
-    global expNumSlices
-
+def padDimensions(tileMode, padDims, isCube, cubeAsArray, pitchAlign, heightAlign, sliceAlign,
+                  expPitch, expHeight, expNumSlices):
     thickness = computeSurfaceThickness(tileMode)
     if not padDims:
         padDims = 3
@@ -686,10 +695,6 @@ def computeSurfaceAlignmentsLinear(tileMode, bpp, flags):
 
 
 def computeSurfaceInfoLinear(tileMode, bpp, numSamples, pitch, height, numSlices, mipLevel, padDims, flags):
-    global expPitch
-    global expHeight
-    global expNumSlices
-
     expPitch = pitch
     expHeight = height
     expNumSlices = numSlices
@@ -726,7 +731,10 @@ def computeSurfaceInfoLinear(tileMode, bpp, numSamples, pitch, height, numSlices
         (flags.value >> 7) & 1,
         pitchAlign,
         heightAlign,
-        microTileThickness)
+        microTileThickness,
+        expPitch,
+        expHeight,
+        expNumSlices)
 
     if (flags.value >> 9) & 1 and not mipLevel:
         expPitch *= 3
@@ -759,10 +767,6 @@ def computeSurfaceAlignmentsMicroTiled(tileMode, bpp, flags, numSamples):
 
 
 def computeSurfaceInfoMicroTiled(tileMode, bpp, numSamples, pitch, height, numSlices, mipLevel, padDims, flags):
-    global expPitch
-    global expHeight
-    global expNumSlices
-
     expTileMode = tileMode
     expPitch = pitch
     expHeight = height
@@ -803,7 +807,10 @@ def computeSurfaceInfoMicroTiled(tileMode, bpp, numSamples, pitch, height, numSl
         (flags.value >> 7) & 1,
         pitchAlign,
         heightAlign,
-        microTileThickness)
+        microTileThickness,
+        expPitch,
+        expHeight,
+        expNumSlices)
 
     pPitchOut = expPitch
     pHeightOut = expHeight
@@ -851,10 +858,6 @@ def computeSurfaceAlignmentsMacroTiled(tileMode, bpp, flags, numSamples):
 
 
 def computeSurfaceInfoMacroTiled(tileMode, baseTileMode, bpp, numSamples, pitch, height, numSlices, mipLevel, padDims, flags):
-    global expPitch
-    global expHeight
-    global expNumSlices
-
     expPitch = pitch
     expHeight = height
     expNumSlices = numSlices
@@ -900,7 +903,10 @@ def computeSurfaceInfoMacroTiled(tileMode, baseTileMode, bpp, numSamples, pitch,
             (flags.value >> 7) & 1,
             pitchAlign,
             heightAlign,
-            microTileThickness)
+            microTileThickness,
+            expPitch,
+            expHeight,
+            expNumSlices)
 
         pPitchOut = expPitch
         pHeightOut = expHeight
@@ -954,7 +960,10 @@ def computeSurfaceInfoMacroTiled(tileMode, baseTileMode, bpp, numSamples, pitch,
                 (flags.value >> 7) & 1,
                 pitchAlign,
                 heightAlign,
-                microTileThickness)
+                microTileThickness,
+                expPitch,
+                expHeight,
+                expNumSlices)
 
             pPitchOut = expPitch
             pHeightOut = expHeight
@@ -970,7 +979,7 @@ def computeSurfaceInfoMacroTiled(tileMode, baseTileMode, bpp, numSamples, pitch,
     return result, pPitchOut, pHeightOut, pNumSlicesOut, pSurfSize, pTileModeOut, pBaseAlign, pPitchAlign, pHeightAlign, pDepthAlign
 
 
-def ComputeSurfaceInfoEx():
+def ComputeSurfaceInfoEx(pIn, pOut):
     tileMode = pIn.tileMode
     bpp = pIn.bpp
     numSamples = max(1, pIn.numSamples)
@@ -1066,7 +1075,7 @@ def ComputeSurfaceInfoEx():
     return 0
 
 
-def restoreSurfaceInfo(elemMode, expandX, expandY, bpp):
+def restoreSurfaceInfo(pOut, elemMode, expandX, expandY, bpp):
     if pOut.pixelPitch and pOut.pixelHeight:
         width = pOut.pixelPitch
         height = pOut.pixelHeight
@@ -1101,13 +1110,7 @@ def restoreSurfaceInfo(elemMode, expandX, expandY, bpp):
     return 0
 
 
-def computeSurfaceInfo(aSurfIn, pSurfOut):
-    global pIn
-    global pOut
-
-    pIn = aSurfIn
-    pOut = pSurfOut
-
+def computeSurfaceInfo(pIn, pOut):
     tileInfoNull = tileInfo()
     sliceFlags = 0
     returnCode = 0
@@ -1116,7 +1119,7 @@ def computeSurfaceInfo(aSurfIn, pSurfOut):
         returnCode = 3
 
     if returnCode == 0:
-        computeMipLevel()
+        computeMipLevel(pIn)
 
         width = pIn.width
         height = pIn.height
@@ -1132,7 +1135,7 @@ def computeSurfaceInfo(aSurfIn, pSurfOut):
             if elemMode == 4 and expandX == 3 and pIn.tileMode == 1:
                 pIn.flags.value |= 0x200
 
-            bpp = adjustSurfaceInfo(elemMode, expandX, expandY, bpp, width, height)
+            bpp = adjustSurfaceInfo(pIn, elemMode, expandX, expandY, bpp, width, height)
 
         elif pIn.bpp:
             pIn.width = max(1, pIn.width)
@@ -1142,7 +1145,7 @@ def computeSurfaceInfo(aSurfIn, pSurfOut):
             returnCode = 3
 
         if returnCode == 0:
-            returnCode = ComputeSurfaceInfoEx()
+            returnCode = ComputeSurfaceInfoEx(pIn, pOut)
 
         if returnCode == 0:
             pOut.bpp = pIn.bpp
@@ -1150,7 +1153,7 @@ def computeSurfaceInfo(aSurfIn, pSurfOut):
             pOut.pixelHeight = pOut.height
 
             if pIn.format and (not (pIn.flags.value >> 9) & 1 or not pIn.mipLevel):
-                bpp = restoreSurfaceInfo(elemMode, expandX, expandY, bpp)
+                bpp = restoreSurfaceInfo(pOut, elemMode, expandX, expandY, bpp)
 
             if sliceFlags:
                 if sliceFlags == 1:
@@ -1170,7 +1173,17 @@ def computeSurfaceInfo(aSurfIn, pSurfOut):
             pOut.sliceTileMax = (pOut.height * pOut.pitch >> 6) - 1
 
 
+def makeSurfaceInfo(pSurfOut):
+    return SurfaceInfo(*[getattr(pSurfOut, name) for name in SurfaceInfo._fields])
+
+
+@lru_cache(maxsize=1024)
 def getSurfaceInfo(surfaceFormat, surfaceWidth, surfaceHeight, surfaceDepth, surfaceDim, surfaceTileMode, surfaceAA, level):
+    """
+    Get the info of a surface as an immutable SurfaceInfo.
+    No state is kept between calls, so it can be called from several
+    threads at once, and the results are memoized.
+    """
     dim = 0
     width = 0
     blockSize = 0
@@ -1193,7 +1206,7 @@ def getSurfaceInfo(surfaceFormat, surfaceWidth, surfaceHeight, surfaceDepth, sur
         width = ~(blockSize - 1) & ((surfaceWidth >> level) + blockSize - 1)
 
         if hwFormat == 0x35:
-            return pSurfOut
+            return makeSurfaceInfo(pSurfOut)
 
         pSurfOut.bpp = formatHwInfo[hwFormat * 4]
         pSurfOut.size = 96
@@ -1306,6 +1319,4 @@ def getSurfaceInfo(surfaceFormat, surfaceWidth, surfaceHeight, surfaceDepth, sur
         pSurfOut.size = 96
         computeSurfaceInfo(aSurfIn, pSurfOut)
 
-        pSurfOut = pOut
-
-    return pSurfOut
+    return makeSurfaceInfo(pSurfOut)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# addrlib_np.py
+# A NumPy (de)swizzling backend for the Address Library.
+# The addresses of all the elements are computed at once as arrays and
+# turned into a gather table, which is cached per surface geometry.
+
+
+################################################################
+################################################################
+
+import numpy as np
+
+from .addrlib import (
+    BCn_formats,
+    computeSurfaceAddrFromCoordMacroTiled,
+    computeSurfaceAddrFromCoordMicroTiled,
+)
+
+from cache import LRUCache
+
+
+def computeSurfaceAddrs(width, height, height_, tileMode, swizzle_, pitch, bitsPerPixel):
+    """
+    Get the swizzled and linear address of every element of the surface
+    """
+    bytesPerPixel = bitsPerPixel // 8
+
+    pipeSwizzle = (swizzle_ >> 8) & 1
+    bankSwizzle = (swizzle_ >> 9) & 3
+
+    # Same order as looping over y, then x
+    y, x = np.indices((height, width), dtype=np.int64)
+    y = y.ravel()
+    x = x.ravel()
+
+    if tileMode in [0, 1]:
+        pos = (y * pitch + x) * bytesPerPixel
+
+    elif tileMode in [2, 3]:
+        pos = computeSurfaceAddrFromCoordMicroTiled(x, y, bitsPerPixel, pitch, tileMode)
+
+    else:
+        pos = computeSurfaceAddrFromCoordMacroTiled(x, y, bitsPerPixel, pitch, height_, tileMode,
+                                                    pipeSwizzle, bankSwizzle)
+
+    pos_ = (y * width + x) * bytesPerPixel
+
+    return pos, pos_
+
+
+def computeSwizzleTable(width, height, height_, format_, tileMode, swizzle_,
+                        pitch, bitsPerPixel, size, swizzle):
+    """
+    Compute the gather table that (de)swizzles a surface in one indexed copy.
+    Returns the size of the units being moved, the index of the source unit
+    for each unit of the result and the units of the result that stay zero.
+    """
+    bytesPerPixel = bitsPerPixel // 8
+
+    if format_ in BCn_formats:
+        width = (width + 3) // 4
+        height = (height + 3) // 4
+
+    pos, pos_ = computeSurfaceAddrs(width, height, height_, tileMode, swizzle_, pitch, bitsPerPixel)
+
+    # Skip the elements that would be out of bounds, like the Python version
+    inBounds = (pos_ + bytesPerPixel <= size) & (pos + bytesPerPixel <= size)
+    pos = pos[inBounds]
+    pos_ = pos_[inBounds]
+
+    if swizzle == 0:
+        dest, src = pos_, pos
+
+    else:
+        dest, src = pos, pos_
+
+    if bytesPerPixel and not (dest % bytesPerPixel).any() and not (src % bytesPerPixel).any():
+        # Move whole elements
+        unit = bytesPerPixel
+        dest = dest // unit
+        src = src // unit
+
+    else:
+        # Move single bytes
+        unit = 1
+        byteOffsets = np.arange(bytesPerPixel, dtype=np.int64)
+        dest = (dest[:, None] + byteOffsets).ravel()
+        src = (src[:, None] + byteOffsets).ravel()
+
+    count = size // unit
+
+    gather = np.zeros(count, dtype=np.int32 if count < 0x80000000 else np.int64)
+    gather[dest] = src
+
+    filled = np.zeros(count, dtype=bool)
+    filled[dest] = True
+    holes = np.flatnonzero(~filled)
+
+    return unit, gather, holes
+
+
+class SwizzleTableCache(LRUCache):
+    """
+    LRU cache of the swizzle tables, bounded by the bytes they use
+    """
+    def sizeOf(self, table):
+        _, gather, holes = table
+        return gather.nbytes + holes.nbytes
+
+    def info(self):
+        info = self.counters()
+        info["Entries"] = len(self.entries)
+        info["Size"] = self.size
+        info["Budget"] = self.budget
+
+        return info
+
+
+tableCache = SwizzleTableCache(64 * 0x100000)
+
+# Move units of these sizes as integers, anything else as raw bytes
+unitTypes = {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}
+
+
+def swizzleSurf(width, height, height_, format_, tileMode, swizzle_,
+                pitch, bitsPerPixel, data, swizzle):
+
+    size = len(data)
+    key = (width, height, height_, format_, tileMode, swizzle_, pitch, bitsPerPixel, size, swizzle)
+
+    table = tableCache.get(key)
+    if table is None:
+        table = computeSwizzleTable(width, height, height_, format_, tileMode, swizzle_,
+                                    pitch, bitsPerPixel, size, swizzle)
+
+        tableCache.put(key, table)
+
+    unit, gather, holes = table
+    count = size // unit
+
+    src = np.frombuffer(data, dtype=unitTypes.get(unit, 'V%d' % unit), count=count)
+    result = src[gather]
+
+    if len(holes):
+        result.view(np.uint8).reshape(count, unit)[holes] = 0
+
+    if count * unit < size:
+        return result.tobytes() + bytes(size - count * unit)
+
+    return result.tobytes()
+
+
+def deswizzle(width, height, height_, format_, tileMode, swizzle_,
+              pitch, bpp, data):
+
+    return swizzleSurf(width, height, height_, format_, tileMode, swizzle_, pitch, bpp, data, 0)
+
+
+def swizzle(width, height, height_, format_, tileMode, swizzle_,
+            pitch, bpp, data):
+
+    return swizzleSurf(width, height, height_, format_, tileMode, swizzle_, pitch, bpp, data, 1)
+
+
+def cacheInfo():
+    return tableCache.info()
+
+
+def setCacheBudget(budget):
+    tableCache.setBudget(budget)
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""benchmark.py: Microbenchmarks of the hot functions on every available backend."""
+
+import argparse
+from contextlib import redirect_stdout
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+import globals
+
+try:
+    import pyximport
+    pyximport.install()
+
+    import cython_available
+
+except:
+    pass
+
+else:
+    del cython_available
+    globals.cython_available = True
+
+import addrlib
+import form_conv
+import yaz0
+import yaz0_builtin
+
+try:
+    import form_conv_np
+
+except ImportError:
+    form_conv_np = None
+
+try:
+    import form_conv_cy
+
+except:
+    form_conv_cy = None
+
+try:
+    import libyaz0
+
+except ImportError:
+    libyaz0 = None
+
+try:
+    import SarcLib
+
+except ImportError:
+    SarcLib = None
+
+
+class Skip(Exception):
+    """
+    Raised by a benchmark whose dependencies are missing
+    """
+
+
+# Formats supported by dds.readDDS and writeFLIM
+# (A4L4 is left out, writeFLIM has no FLIM format for it):
+# name -> (pixel format flags, fourcc, bits per pixel, channel masks)
+DDSFormats = {
+    "RGBA8": (0x41, b'', 32, (0xff, 0xff00, 0xff0000, 0xff000000)),
+    "BGRA8": (0x41, b'', 32, (0xff0000, 0xff00, 0xff, 0xff000000)),
+    "RGB8": (0x40, b'', 24, (0xff, 0xff00, 0xff0000, 0)),
+    "BGR10A2": (0x41, b'', 32, (0x3ff, 0xffc00, 0x3ff00000, 0xc0000000)),
+    "RGB10A2": (0x41, b'', 32, (0x3ff00000, 0xffc00, 0x3ff, 0xc0000000)),
+    "RGB565": (0x40, b'', 16, (0x1f, 0x7e0, 0xf800, 0)),
+    "BGR565": (0x40, b'', 16, (0xf800, 0x7e0, 0x1f, 0)),
+    "RGB5A1": (0x41, b'', 16, (0x1f, 0x3e0, 0x7c00, 0x8000)),
+    "BGR5A1": (0x41, b'', 16, (0x7c00, 0x3e0, 0x1f, 0x8000)),
+    "RGBA4": (0x41, b'', 16, (0xf, 0xf0, 0xf00, 0xf000)),
+    "BGRA4": (0x41, b'', 16, (0xf00, 0xf0, 0xf, 0xf000)),
+    "L8": (0x20000, b'', 8, (0xff, 0, 0, 0)),
+    "A8L8": (0x20001, b'', 16, (0xff, 0xff00, 0, 0)),
+    "ETC1": (4, b'ETC1', 0, (0, 0, 0, 0)),
+    "DXT1": (4, b'DXT1', 0, (0, 0, 0, 0)),
+    "DXT3": (4, b'DXT3', 0, (0, 0, 0, 0)),
+    "DXT5": (4, b'DXT5', 0, (0, 0, 0, 0)),
+    "BC4U": (4, b'BC4U', 0, (0, 0, 0, 0)),
+    "BC4S": (4, b'BC4S', 0, (0, 0, 0, 0)),
+    "BC5U": (4, b'BC5U', 0, (0, 0, 0, 0)),
+    "BC5S": (4, b'BC5S', 0, (0, 0, 0, 0)),
+}
+
+# Bytes per 4x4 block of the compressed formats
+DDSBlockSizes = {
+    b'ETC1': 8, b'DXT1': 8, b'DXT3': 16, b'DXT5': 16,
+    b'BC4U': 8, b'BC4S': 8, b'BC5U': 16, b'BC5S': 16,
+}
+
+
+def makeDDS(rng, width, height, format_):
+    """
+    Generate a DDS file with random pixels
+    """
+    pflags, fourcc, bpp, masks = DDSFormats[format_]
+
+    if fourcc:
+        size = ((width + 3) // 4) * ((height + 3) // 4) * DDSBlockSizes[fourcc]
+
+    else:
+        size = width * height * bpp // 8
+
+    head = bytearray(0x80)
+    head[:4] = b'DDS '
+    struct.pack_into('<7I', head, 4, 124, 0x1007, height, width, size if fourcc else width * bpp // 8, 0, 1)
+    struct.pack_into('<2I4s5I', head, 76, 32, pflags, fourcc, bpp, *masks)
+    struct.pack_into('<I', head, 108, 0x1000)
+
+    return bytes(head) + randomBytes(rng, size)
+
+
+def randomBytes(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def makeCompressibleData(rng, size):
+    """
+    Generate data that compresses about as well as the game files
+    """
+    words = [randomBytes(rng, rng.randrange(4, 64)) for _ in range(64)]
+
+    data = bytearray()
+    while len(data) < size:
+        if rng.random() < 0.2:
+            data += randomBytes(rng, rng.randrange(1, 32))
+
+        elif rng.random() < 0.1:
+            data += bytes(rng.randrange(16, 256))
+
+        else:
+            data += rng.choice(words)
+
+    return bytes(data[:size])
+
+
+def makeSARC(files):
+    """
+    Build a SARC archive from a dict of path -> data
+    """
+    arc = SarcLib.SARC_Archive()
+
+    for path, data in files.items():
+        folder = arc
+        for name in path.split('/')[:-1]:
+            for entry in folder.contents:
+                if isinstance(entry, SarcLib.Folder) and entry.name == name:
+                    folder = entry
+                    break
+
+            else:
+                entry = SarcLib.Folder(name)
+                folder.addFolder(entry)
+                folder = entry
+
+        folder.addFile(SarcLib.File(path.split('/')[-1], data))
+
+    return arc.save()[0]
+
+
+def makeCourse(tilesets, spriteIDs):
+    """
+    Generate a course file with the given tilesets and sprites
+    """
+    blocks = [b''] * 15
+    blocks[0] = b''.join(name.encode('utf-8').ljust(32, b'\0') for name in tilesets)
+    blocks[7] = b''.join(struct.pack('>HHH10sxx2sxxxx', id, 16 * i, 16, b'', b'')
+                         for i, id in enumerate(spriteIDs)) + b'\xFF\xFF\xFF\xFF'
+
+    offset = len(blocks) * 8
+    head = bytearray()
+    body = bytearray()
+
+    for block in blocks:
+        head += struct.pack('>II', offset + len(body) if block else 0, len(block))
+        body += block
+
+    return bytes(head + body)
+
+
+def checksum(result):
+    if isinstance(result, (bytes, bytearray)):
+        return hashlib.md5(result).hexdigest()
+
+    return None
+
+
+def surfaceArgs(width, height, format_, tileMode):
+    """
+    Get the arguments of addrlib.swizzle() for a surface, the same way as writeFLIM
+    """
+    surfOut = addrlib.getSurfaceInfo(format_, width, height, 1, 1, tileMode, 0, 0)
+
+    if tileMode in [1, 2, 3, 16]:
+        s = 0
+
+    else:
+        s = 0xd0000
+
+    return surfOut, (width, height, surfOut.height, format_, surfOut.tileMode, s, surfOut.pitch, surfOut.bpp)
+
+
+def benchSwizzle(ctx):
+    """
+    addrlib.swizzle() and deswizzle() for every tile mode
+    """
+    size = ctx.size
+
+    for tileMode in range(17):
+        surfOut, args = surfaceArgs(size, size, 0x1a, tileMode)
+        data = randomBytes(ctx.rng, surfOut.surfSize)
+
+        for backend, module in addrlib.backends.items():
+            for func in 'swizzle', 'deswizzle':
+                name = '%s/tileMode%d' % (func, tileMode)
+                yield name, backend, len(data), lambda f=getattr(module, func): f(*args, data)
+
+        if addrlib.addrlib_np is not None:
+            # Without the cached swizzle tables
+            def uncached(args=args, data=data):
+                budget = addrlib.addrlib_np.cacheInfo()["Budget"]
+                addrlib.addrlib_np.setCacheBudget(0)
+
+                try:
+                    return addrlib.addrlib_np.swizzle(*args, data)
+
+                finally:
+                    addrlib.addrlib_np.setCacheBudget(budget)
+
+            yield 'swizzle/tileMode%d' % tileMode, 'numpy-uncached', len(data), uncached
+
+
+def benchSurfaceInfo(ctx):
+    """
+    addrlib.getSurfaceInfo() for every tile mode and the common formats
+    """
+    cases = [(format_, 1 << size, 1 << size, tileMode, level)
+             for format_ in [0x1a, 0x8, 0x1, 0x31, 0x33, 0x35]
+             for size in range(2, 11)
+             for tileMode in range(17)
+             for level in range(2)]
+
+    backends = {
+        'python': addrlib.addrlib_py.getSurfaceInfo.__wrapped__,
+        'python-memoized': addrlib.getSurfaceInfo,
+    }
+
+    if addrlib.addrlib_cy is not None:
+        backends['cython'] = addrlib.addrlib_cy.getSurfaceInfo
+
+    for backend, getSurfaceInfo in backends.items():
+        def run(getSurfaceInfo=getSurfaceInfo):
+            for format_, width, height, tileMode, level in cases:
+                getSurfaceInfo(format_, width, height, 1, 1, tileMode, 0, level)
+
+        yield 'getSurfaceInfo/x%d' % len(cases), backend, 0, run
+
+
+def benchFormConv(ctx):
+    """
+    The form_conv conversions
+    """
+    backends = {'python': form_conv}
+
+    if form_conv_cy is not None:
+        backends['cython'] = form_conv_cy
+
+    if form_conv_np is not None:
+        backends['numpy'] = form_conv_np
+
+    numPixels = ctx.size * ctx.size
+    data16 = randomBytes(ctx.rng, numPixels * 2)
+    data24 = bytearray(randomBytes(ctx.rng, numPixels * 3))
+    data32 = randomBytes(ctx.rng, numPixels * 4)
+
+    for backend, module in backends.items():
+        yield 'rgb8torgbx8', backend, len(data24), lambda m=module: m.rgb8torgbx8(data24)
+        yield 'rgba4_to_argb4', backend, len(data16), lambda m=module: m.rgba4_to_argb4(data16)
+
+        for format_ in 'rgb565', 'rgb5a1', 'rgba4', 'argb4':
+            yield 'swapRB_16bpp/' + format_, backend, len(data16), lambda m=module, f=format_: m.swapRB_16bpp(data16, f)
+
+        for format_ in 'bgr10a2', 'rgba8':
+            yield 'swapRB_32bpp/' + format_, backend, len(data32), lambda m=module, f=format_: m.swapRB_32bpp(data32, f)
+
+
+def benchFLIM(ctx):
+    """
+    writeFLIM() for every DDS format, on every (de)swizzling backend
+    """
+    from bflim import writeFLIM
+
+    folder = os.path.join(ctx.tmp, 'dds')
+    os.makedirs(folder, exist_ok=True)
+
+    for format_ in DDSFormats:
+        fname = os.path.join(folder, format_ + '.dds')
+        with open(fname, 'wb') as out:
+            out.write(makeDDS(ctx.rng, ctx.size, ctx.size, format_))
+
+        for backend in addrlib.backends:
+            def run(backend=backend, fname=fname):
+                current = addrlib.backend
+                addrlib.useBackend(backend)
+
+                try:
+                    return writeFLIM(fname, 4, 0, False)
+
+                finally:
+                    addrlib.useBackend(current)
+
+            yield 'writeFLIM/' + format_, backend, os.path.getsize(fname), run
+
+
+def benchYaz0(ctx):
+    """
+    Yaz0 compression and decompression
+    """
+    data = makeCompressibleData(ctx.rng, ctx.yaz0Size)
+    compressed = yaz0_builtin.compress(data, 1)
+
+    for preset, level in yaz0.Presets.items():
+        yield 'compress/' + preset, 'builtin', len(data), lambda l=level: yaz0_builtin.compress(data, l)
+
+    yield 'decompress', 'builtin', len(data), lambda: yaz0_builtin.decompress(compressed)
+
+    if libyaz0 is not None:
+        for preset, level in yaz0.Presets.items():
+            yield 'compress/' + preset, 'libyaz0', len(data), lambda l=level: libyaz0.compress(data, 0, l)
+
+        yield 'decompress', 'libyaz0', len(data), lambda: libyaz0.decompress(compressed)
+
+    if wszstAvailable():
+        for preset, level in yaz0.Presets.items():
+            yield 'compress/' + preset, 'wszst', len(data), lambda l=level: yaz0.compressWSZST(data, l)
+        yield 'decompress', 'wszst', len(data), lambda: yaz0.decompressWSZST(compressed)
+
+
+def wszstAvailable():
+    return os.path.isfile(yaz0.getWSZSTPath())
+
+
+def benchLevel(ctx):
+    """
+    Level.load() and Level.save() of a synthetic level
+    """
+    if SarcLib is None:
+        raise Skip("SarcLib is not installed")
+
+    import cache
+    import level
+
+    globals.gamepath = os.path.join(ctx.tmp, 'game')
+    globals.mod_path = os.path.join(ctx.tmp, 'mod')
+    globals.cachepath = ''
+
+    os.makedirs(os.path.join(globals.gamepath, 'Common/actor'), exist_ok=True)
+    os.makedirs(os.path.join(globals.mod_path, 'Stage/Texture'), exist_ok=True)
+
+    tilesets = ['Pa0_jyotyu', 'Pa1_nohara', '', '']
+    for name in tilesets[:2]:
+        data = makeSARC({
+            'BG_tex/%s.gtx' % name: makeCompressibleData(ctx.rng, 0x40000),
+            'BG_chk/d_bgchk_%s.bin' % name: bytes(0x1000),
+        })
+
+        with open(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % name), 'wb') as out:
+            out.write(yaz0_builtin.compress(data, 1))
+
+    sprites, _ = level.getSpriteResources()
+    spriteIDs = [id for id, names in enumerate(sprites) if names][:24]
+
+    for id in spriteIDs:
+        for name in sprites[id]:
+            fname = os.path.join(globals.gamepath, 'Common/actor/%s.szs' % name)
+            if not os.path.isfile(fname):
+                data = makeSARC({'%s.bfres' % name: makeCompressibleData(ctx.rng, 0x4000)})
+                with open(fname, 'wb') as out:
+                    out.write(yaz0_builtin.compress(data, 1))
+
+    name = '1-1'
+    files = {
+        name: makeSARC({
+            'course/course1.bin': makeCourse(tilesets, spriteIDs * 8),
+            'course/course1_bgdatL1.bin': makeCompressibleData(ctx.rng, 0x2000),
+        }),
+    }
+
+    def load():
+        lvl = level.Level(name)
+        lvl.load(dict(files))
+        return lvl
+
+    def save():
+        cache.spriteCache.clear()
+        cache.tilesetCache.clear()
+        return load().save()
+
+    yield 'Level.load', 'default', len(files[name]), load
+    yield 'Level.save', 'default', len(files[name]), save
+
+
+def benchBFSAR(ctx):
+    """
+    patchBFSAR() on a fake, sparse Sound Archive
+    """
+    try:
+        import main
+
+    except Exception as e:
+        raise Skip("main.py can't be imported: %s" % e)
+
+    from manifest import BuildManifest
+
+    globals.gamepath = os.path.join(ctx.tmp, 'game')
+    globals.mod_path = os.path.join(ctx.tmp, 'mod')
+    globals.patchpath = os.path.join(ctx.tmp, 'Patch')
+    globals.incremental = False
+    globals.manifest = BuildManifest(os.path.join(ctx.tmp, 'manifest.json'))
+
+    os.makedirs(os.path.join(globals.gamepath, 'CAFE/sound'), exist_ok=True)
+    os.makedirs(os.path.join(globals.mod_path, 'Sound'), exist_ok=True)
+    os.makedirs(os.path.join(globals.patchpath, 'content/CAFE'), exist_ok=True)
+
+    # Only inject the first tracks, to keep the archive small
+    tracks = sorted(globals.Tracks, key=lambda track: sum(globals.Tracks[track]))[:2]
+    fsarSize = max(sum(globals.Tracks[track]) for track in tracks)
+
+    with open(os.path.join(globals.gamepath, 'CAFE/sound/cafe_redpro_sound.bfsar'), 'wb') as out:
+        out.write(b'FSAR')
+        out.truncate(fsarSize)
+
+    injected = 0
+    for track in tracks:
+        size = globals.Tracks[track][1]
+        fwav = bytearray(b'FWAV\xFE\xFF') + randomBytes(ctx.rng, size - 6)
+        struct.pack_into('>I', fwav, 12, size)
+
+        with open(os.path.join(globals.mod_path, 'Sound/%s.bfwav' % track), 'wb') as out:
+            out.write(fwav)
+
+        injected += size
+
+    yield 'patchBFSAR', 'default', injected, main.patchBFSAR
+
+
+# group -> function yielding (name, backend, bytes processed, function to time)
+Benchmarks = {
+    "swizzle": benchSwizzle,
+    "surfaceInfo": benchSurfaceInfo,
+    "form_conv": benchFormConv,
+    "bflim": benchFLIM,
+    "yaz0": benchYaz0,
+    "level": benchLevel,
+    "bfsar": benchBFSAR,
+}
+
+
+class Context:
+    def __init__(self, args, tmp):
+        self.rng = random.Random(args.seed)
+        self.size = args.size
+        self.yaz0Size = args.yaz0_size * 1024
+        self.tmp = tmp
+
+
+def timeCase(func, repeat):
+    """
+    Time a function, returning the times of every run and the result of the last one
+    """
+    times = []
+    result = None
+
+    # Keep the warnings of the functions out of the results
+    with open(os.devnull, 'w') as null, redirect_stdout(null):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+
+    return times, result
+
+
+def runBenchmarks(args, tmp):
+    ctx = Context(args, tmp)
+    results = []
+    failed = []
+    skipped = {}
+
+    for group, bench in Benchmarks.items():
+        if args.group and group not in args.group:
+            continue
+
+        try:
+            for name, backend, size, func in bench(ctx):
+                fullName = '%s/%s' % (group, name)
+                if args.filter and args.filter not in '%s [%s]' % (fullName, backend):
+                    continue
+
+                try:
+                    times, result = timeCase(func, args.repeat)
+
+                except Exception as e:
+                    failed.append({"Name": fullName, "Backend": backend, "Error": repr(e)})
+                    print("%-40s %-16s failed: %r" % (fullName, backend, e))
+                    continue
+
+                best = min(times)
+                results.append({
+                    "Group": group,
+                    "Name": fullName,
+                    "Backend": backend,
+                    "Bytes": size,
+                    "Runs": len(times),
+                    "Min": best,
+                    "Median": statistics.median(times),
+                    "Mean": statistics.mean(times),
+                    "Throughput": size / best / 0x100000 if size and best else None,
+                    "OutputBytes": len(result) if isinstance(result, (bytes, bytearray)) else None,
+                    "Checksum": checksum(result),
+                })
+
+                print("%-40s %-16s %10.3f ms" % (fullName, backend, best * 1000)
+                      + ("  %8.2f MiB/s" % results[-1]["Throughput"] if results[-1]["Throughput"] else ''))
+
+        except Skip as e:
+            skipped[group] = str(e)
+            print("%-40s skipped: %s" % (group, e))
+
+    return results, failed, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OtherSMBU Patcher benchmarks")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="number of runs of each benchmark, the fastest one is reported (default: 3)")
+    parser.add_argument('-g', '--group', action='append', choices=list(Benchmarks),
+                        help="only run this group of benchmarks, can be given more than once")
+    parser.add_argument('-k', '--filter', default='',
+                        help="only run the benchmarks whose name or backend contains this")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write the results as JSON to this file, - for stdout")
+    parser.add_argument('--size', type=int, default=256,
+                        help="width and height of the generated textures (default: 256)")
+    parser.add_argument('--yaz0-size', type=int, default=256, metavar='KB',
+                        help="size of the generated data for Yaz0 (default: 256)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated fixtures")
+    args = parser.parse_args()
+
+    args.repeat = max(1, args.repeat)
+
+    # The results go to stdout, so print the progress somewhere else
+    if args.output == '-':
+        stdout, sys.stdout = sys.stdout, sys.stderr
+
+    tmp = tempfile.mkdtemp(prefix='othersmbu-bench-')
+    try:
+        results, failed, skipped = runBenchmarks(args, tmp)
+
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "Version": globals.version,
+        "Python": platform.python_version(),
+        "Platform": platform.platform(),
+        "Backends": {
+            "addrlib": list(addrlib.backends),
+            "form_conv": ["python"] + (["cython"] if form_conv_cy is not None else []) + (["numpy"] if form_conv_np is not None else []),
+            "yaz0": ["builtin"] + (["libyaz0"] if libyaz0 is not None else []) + (["wszst"] if wszstAvailable() else []),
+        },
+        "Settings": {
+            "Repeat": args.repeat,
+            "Size": args.size,
+            "Yaz0Size": args.yaz0_size * 1024,
+            "Seed": args.seed,
+        },
+        "SwizzleCache": addrlib.cacheInfo(),
+        "Skipped": skipped,
+        "Failed": failed,
+        "Results": results,
+    }
+
+    if args.output == '-':
+        sys.stdout = stdout
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    elif args.output:
+        with open(args.output, 'w', encoding='utf-8') as out:
+            json.dump(report, out, indent=1)
+
+
+if __name__ == '__main__':
+    main()
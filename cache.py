@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""cache.py: On-disk caches shared between runs and worker processes."""
+
+from collections import OrderedDict
+import mmap
+import os
+import shutil
+
+import globals
+from manifest import hashData, hashFile, statFile
+
+from yaz0 import determineCompressionMethod
+_, DecompYaz0 = determineCompressionMethod()
+
+
+def readCacheFile(path):
+    try:
+        with open(path, "rb") as inf:
+            return inf.read()
+
+    except OSError:
+        return None
+
+
+def mapCacheFile(path):
+    """
+    Map a cache file into memory read-only, or return None if it can't be
+    """
+    try:
+        with open(path, "rb") as inf:
+            return mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+
+    except (OSError, ValueError):
+        return None
+
+
+def writeCacheFile(path, data):
+    """
+    Write a cache file atomically, so that other processes never see it half-written
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(data)
+
+    os.replace(tmp, path)
+
+
+def loadActor(name, md5):
+    """
+    Get the decompressed data of a game actor.
+    The cached copy is keyed by the md5 from spriteresources.xml and is only
+    used if the size and modification time of the actor in the game files
+    didn't change since it was cached.
+    """
+    szsname = os.path.join(globals.gamepath, 'Common/actor/%s.szs' % name)
+    signature = statFile(szsname)
+
+    if not signature:
+        return None
+
+    if globals.cachepath and md5:
+        entry = os.path.join(globals.cachepath, 'actor/%s.%s' % (name, md5))
+
+        if readCacheFile(entry + '.src') == signature.encode('utf-8'):
+            data = readCacheFile(entry)
+            if data is not None:
+                return data
+
+    else:
+        entry = ''
+
+    with open(szsname, 'rb') as inf:
+        data = DecompYaz0(inf.read())
+
+    if entry and data:
+        writeCacheFile(entry, data)
+        writeCacheFile(entry + '.src', signature.encode('utf-8'))
+
+    return data
+
+
+def cacheActor(name, md5):
+    """
+    Make sure the decompressed data of a game actor is in the disk cache,
+    without reading it if it already is.
+    Returns False if the actor can't be cached.
+    """
+    if not (globals.cachepath and md5):
+        return False
+
+    signature = statFile(os.path.join(globals.gamepath, 'Common/actor/%s.szs' % name))
+    entry = os.path.join(globals.cachepath, 'actor/%s.%s' % (name, md5))
+
+    if signature and readCacheFile(entry + '.src') == signature.encode('utf-8') and os.path.isfile(entry):
+        return True
+
+    return bool(loadActor(name, md5))
+
+
+def loadLayout(name):
+    """
+    Get the decompressed SARC of a game layout, as a memory map of the
+    cached copy if there is one, which the caller should close.
+    The cached copy is keyed by the size, modification time and md5 of the
+    layout in the game files. It's only hashed again if the first two changed.
+    """
+    szsname = os.path.join(globals.gamepath, 'Common/layout/%s.szs' % name)
+    signature = statFile(szsname)
+
+    if not signature:
+        return None
+
+    if not globals.cachepath:
+        with open(szsname, 'rb') as inf:
+            return DecompYaz0(inf.read())
+
+    entry = os.path.join(globals.cachepath, 'layout/%s.sarc' % name)
+    source = (readCacheFile(entry + '.src') or b'').decode('utf-8').split()
+
+    if len(source) != 2 or source[0] != signature:
+        with open(szsname, 'rb') as inf:
+            inb = inf.read()
+
+        md5 = hashData(inb)
+
+        if len(source) != 2 or source[1] != md5 or not os.path.isfile(entry):
+            data = DecompYaz0(inb)
+
+            if data:
+                writeCacheFile(entry, data)
+                writeCacheFile(entry + '.src', ('%s %s' % (signature, md5)).encode('utf-8'))
+
+            return data
+
+        # Only touched, so the cached copy is still good
+        writeCacheFile(entry + '.src', ('%s %s' % (signature, md5)).encode('utf-8'))
+
+    data = mapCacheFile(entry)
+    if data is not None:
+        return data
+
+    with open(szsname, 'rb') as inf:
+        return DecompYaz0(inf.read())
+
+
+def pruneActors():
+    """
+    Remove the cached actors whose actor in the game files changed or was removed
+    """
+    folder = os.path.join(globals.cachepath, 'actor')
+    if not os.path.isdir(folder):
+        return
+
+    for name in os.listdir(folder):
+        if name.endswith('.src'):
+            continue
+
+        actor = name.rpartition('.')[0]
+        signature = statFile(os.path.join(globals.gamepath, 'Common/actor/%s.szs' % actor))
+        entry = os.path.join(folder, name)
+
+        if not signature or readCacheFile(entry + '.src') != signature.encode('utf-8'):
+            os.remove(entry)
+
+            if os.path.isfile(entry + '.src'):
+                os.remove(entry + '.src')
+
+
+def pruneTilesets():
+    """
+    Remove the cached tilesets whose tileset in the mod changed or was removed
+    """
+    folder = os.path.join(globals.cachepath, 'tileset')
+    if not os.path.isdir(folder):
+        return
+
+    for name in os.listdir(folder):
+        tileset, _, md5 = name.rpartition('.')
+
+        if md5 != hashFile(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % tileset)):
+            os.remove(os.path.join(folder, name))
+
+
+def getCompressedEntry(md5):
+    return os.path.join(globals.cachepath, 'szs/%s.%s.szs' % (md5, globals.preset))
+
+
+def loadCompressed(md5, outf):
+    """
+    Copy the compressed output of the data with the given md5 and the
+    current preset from the store to outf.
+    Returns False if it isn't stored.
+    """
+    if not (globals.cachepath and globals.szs_cache_size):
+        return False
+
+    entry = getCompressedEntry(md5)
+
+    try:
+        shutil.copyfile(entry, outf)
+
+        # The modification time tells which entries were used last
+        os.utime(entry)
+
+    except OSError:
+        return False
+
+    return True
+
+
+def storeCompressed(md5, path):
+    """
+    Add the compressed output in path to the store, under the md5
+    of the uncompressed data and the current preset
+    """
+    if not (globals.cachepath and globals.szs_cache_size):
+        return
+
+    entry = getCompressedEntry(md5)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    tmp = '%s.%d.tmp' % (entry, os.getpid())
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, entry)
+
+
+def trimCompressed(size):
+    """
+    Remove the least recently used compressed outputs
+    until the store takes at most size bytes
+    """
+    folder = os.path.join(globals.cachepath, 'szs')
+    if not os.path.isdir(folder):
+        return
+
+    entries = []
+    for name in os.listdir(folder):
+        if name.endswith('.szs'):
+            st = os.stat(os.path.join(folder, name))
+            entries.append((st.st_mtime_ns, st.st_size, name))
+
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+
+    for _, entrySize, name in entries:
+        if total <= size:
+            break
+
+        os.remove(os.path.join(folder, name))
+        total -= entrySize
+
+
+class LRUCache:
+    """
+    LRU cache of decompressed files, bounded by the bytes they use
+    as given by sizeOf()
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return data
+
+    def sizeOf(self, data):
+        return len(data)
+
+    def put(self, key, data):
+        if self.sizeOf(data) > self.budget:
+            return
+
+        if key in self.entries:
+            self.size -= self.sizeOf(self.entries.pop(key))
+
+        self.entries[key] = data
+        self.size += self.sizeOf(data)
+
+        self.trim()
+
+    def trim(self):
+        while self.entries and self.size > self.budget:
+            _, data = self.entries.popitem(last=False)
+            self.size -= self.sizeOf(data)
+            self.evictions += 1
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.trim()
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def counters(self):
+        return {
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Evictions": self.evictions,
+        }
+
+
+class TilesetCache(LRUCache):
+    """
+    LRU cache of the decompressed tilesets of the mod, in front of
+    a disk cache shared with the other processes.
+    The entries are keyed by the md5 of the compressed tileset.
+    The misses that were found on disk are counted as disk hits.
+    """
+    def __init__(self, budget):
+        super().__init__(budget)
+        self.diskHits = 0
+
+    def load(self, name):
+        """
+        Get the decompressed data of a tileset, or None if it doesn't exist
+        """
+        szsname = os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % name)
+        md5 = hashFile(szsname)
+
+        if not md5:
+            return None
+
+        key = (name, md5)
+
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        entry = os.path.join(globals.cachepath, 'tileset/%s.%s' % (name, md5)) if globals.cachepath else ''
+
+        data = readCacheFile(entry) if entry else None
+        if data is not None:
+            self.diskHits += 1
+
+        else:
+            with open(szsname, 'rb') as inf:
+                data = DecompYaz0(inf.read())
+
+            if entry and data:
+                writeCacheFile(entry, data)
+
+        if data:
+            self.put(key, data)
+
+        return data
+
+    def counters(self):
+        counters = super().counters()
+        counters["DiskHits"] = self.diskHits
+
+        return counters
+
+
+class SpriteCache(LRUCache):
+    """
+    LRU cache of the decompressed game actors used by the levels.
+    Missing entries, including evicted ones, are brought back by reload(name, md5).
+    """
+    def __init__(self, budget, reload):
+        super().__init__(budget)
+        self.reload = reload
+
+        # Names of the entries that were evicted, to count how many come back
+        self.evicted = set()
+        self.reloads = 0
+
+    def load(self, name, md5):
+        """
+        Get the decompressed data of an actor, or None if it doesn't exist
+        """
+        data = self.get(name)
+        if data is not None:
+            return data
+
+        if name in self.evicted:
+            self.evicted.discard(name)
+            self.reloads += 1
+
+        data = self.reload(name, md5)
+        if data:
+            self.put(name, data)
+
+        return data
+
+    def trim(self):
+        while self.entries and self.size > self.budget:
+            name, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+            self.evicted.add(name)
+
+    def counters(self):
+        counters = super().counters()
+        counters["Reloads"] = self.reloads
+
+        return counters
+
+
+tilesetCache = TilesetCache(256 * 0x100000)
+spriteCache = SpriteCache(256 * 0x100000, loadActor)
+
+
+def loadTileset(name):
+    """
+    Get the decompressed data of a tileset of the mod, or None if it doesn't exist
+    """
+    return tilesetCache.load(name)
+
+
+def loadSprite(name, md5):
+    """
+    Get the decompressed data of a game actor through the sprite cache,
+    or None if it doesn't exist
+    """
+    return spriteCache.load(name, md5)
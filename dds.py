@@ -34,7 +34,11 @@ try:
     import form_conv_cy as form_conv
 
 except ImportError:
-    import form_conv
+    try:
+        import form_conv_np as form_conv
+
+    except ImportError:
+        import form_conv
 
 
 def readDDS(f, SRGB):
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""dependencies.py: Index of the resources each level depends on."""
+
+import json
+import os
+
+from level import getResourceNames
+
+IndexVersion = 1
+
+
+def getLevelDependencies(md5, level):
+    """
+    Get the entry of a loaded level in the dependency index
+    """
+    return {
+        "Level": md5,
+        "Sprites": sorted(level.getSpriteIDs()),
+        "Tilesets": sorted(level.getTilesetNames()),
+        "Files": sorted(level.szsData),
+    }
+
+
+def getLevelActors(entry):
+    """
+    Get the game actors needed by a level, leaving out the files it comes with
+    """
+    return sorted(name for name in getResourceNames(entry["Sprites"]) if name not in entry["Files"])
+
+
+class DependencyIndex:
+    """
+    Records the sprites, tilesets and files of each level archive, so that
+    they are known without loading it again while the archive doesn't change.
+    The sprites are only turned into actors when needed, so a change to
+    spriteresources.xml only affects the levels using the sprites it touches.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.levels = {}
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as inf:
+                index = json.load(inf)
+
+        except (OSError, ValueError):
+            return
+
+        if index.get("Version") == IndexVersion:
+            self.levels = index["Levels"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + '.tmp', "w", encoding='utf-8') as out:
+            json.dump({"Version": IndexVersion, "Levels": self.levels}, out, indent=1, sort_keys=True)
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def get(self, f, md5):
+        """
+        Get the entry of a level archive, or None if it changed since it was indexed
+        """
+        entry = self.levels.get(f)
+        if entry is None or entry["Level"] != md5:
+            return None
+
+        return entry
+
+    def update(self, f, entry):
+        self.levels[f] = entry
+
+    def prune(self, levels):
+        """
+        Forget the level archives that are no longer in the Stage folder
+        """
+        for f in list(self.levels):
+            if f not in levels:
+                del self.levels[f]
+
+    def whoUses(self, name):
+        """
+        Get the (level, kind) of each level using an actor or a tileset
+        """
+        users = []
+        for f in sorted(self.levels):
+            entry = self.levels[f]
+
+            if name in entry["Tilesets"]:
+                users.append((f[:-4], 'tileset'))
+
+            if name in getLevelActors(entry):
+                users.append((f[:-4], 'actor'))
+
+        return users
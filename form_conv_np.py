@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright © 2016-2018 AboodXD
+
+# form_conv_np.py
+# A NumPy version of form_conv.
+# Every pixel is converted at once with whole-array bit operations.
+
+################################################################
+################################################################
+
+import numpy as np
+
+
+def rgb8torgbx8(data):
+    numPixels = len(data) // 3
+
+    pixels = np.frombuffer(data, dtype=np.uint8, count=numPixels * 3).reshape(numPixels, 3)
+
+    new_data = np.full((numPixels, 4), 0xFF, dtype=np.uint8)
+    new_data[:, :3] = pixels
+
+    return new_data.tobytes()
+
+
+def swapRB_16bpp(data, format_):
+    numPixels = len(data) // 2
+
+    pixel = np.frombuffer(data, dtype='<u2', count=numPixels)
+
+    if format_ == 'rgb565':
+        red = pixel & 0x1F
+        green = (pixel & 0x7E0) >> 5
+        blue = (pixel & 0xF800) >> 11
+
+        new_pixel = (red << 11) | (green << 5) | blue
+
+    elif format_ == 'rgb5a1':
+        red = pixel & 0x1F
+        green = (pixel & 0x3E0) >> 5
+        blue = (pixel & 0x7c00) >> 10
+        alpha = (pixel & 0x8000) >> 15
+
+        new_pixel = (alpha << 15) | (red << 10) | (green << 5) | blue
+
+    elif format_ == 'rgba4':
+        red = pixel & 0xF
+        green = (pixel & 0xF0) >> 4
+        blue = (pixel & 0xF00) >> 8
+        alpha = (pixel & 0xF000) >> 12
+
+        new_pixel = (alpha << 12) | (red << 8) | (green << 4) | blue
+
+    else:
+        alpha = pixel & 0xF
+        red = (pixel & 0xF0) >> 4
+        green = (pixel & 0xF00) >> 8
+        blue = (pixel & 0xF000) >> 12
+
+        new_pixel = (red << 12) | (green << 8) | (blue << 4) | alpha
+
+    return new_pixel.astype('<u2').tobytes()
+
+
+def rgba4_to_argb4(data):
+    numPixels = len(data) // 2
+
+    pixel = np.frombuffer(data, dtype='<u2', count=numPixels)
+
+    rgb = (pixel & 0xFFF)
+    alpha = (pixel & 0xF000) >> 12
+
+    new_pixel = (rgb << 4) | alpha
+
+    return new_pixel.astype('<u2').tobytes()
+
+
+def swapRB_32bpp(data, format_):
+    numPixels = len(data) // 4
+
+    pixel = np.frombuffer(data, dtype='<u4', count=numPixels)
+
+    if format_ == 'bgr10a2':
+        red = (pixel & 0x3FF00000) >> 20
+        green = (pixel & 0xFFC00) >> 10
+        blue = pixel & 0x3FF
+        alpha = (pixel & 0xC0000000) >> 30
+
+        new_pixel = (alpha << 30) | (blue << 20) | (green << 10) | red
+
+    else:
+        red = pixel & 0xFF
+        green = (pixel & 0xFF00) >> 8
+        blue = (pixel & 0xFF0000) >> 16
+        alpha = (pixel & 0xFF000000) >> 24
+
+        new_pixel = (alpha << 24) | (red << 16) | (green << 8) | blue
+
+    return new_pixel.astype('<u4').tobytes()
@@ -25,12 +25,26 @@ from os.path import dirname, realpath
 import sys
 
 
+version = "0.1"
 curr_path = dirname(realpath(sys.argv[0])).replace("\\", "/")
 cython_available = False
 libyaz0_available = False
 gamepath = ''
+mod_path = ''
 patchpath = ''
-SpriteCache = {}
+cachepath = ''
+jobs = 1
+memory_budget = 0
+incremental = False
+preset = 'fast'
+szs_cache_size = 0
+compression_queue = ''
+tileset_cache_size = 256 * 0x100000
+sprite_cache_size = 256 * 0x100000
+manifest = None
+dependencies = None
+report = None
+trace_malloc = False
 
 Layouts = {
     "ChallengeImage": 0x2000,
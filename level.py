@@ -21,17 +21,135 @@
 ################################################################
 ################################################################
 
+from array import array
 from os import listdir
 import os.path
+import pickle
 import struct
 from xml.etree import ElementTree as etree
 
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
 from bytes import bytes_to_string
+from cache import loadSprite, loadTileset, readCacheFile, writeCacheFile
 import globals
+from manifest import hashFile
 import SarcLib
 
-from yaz0 import determineCompressionMethod
-_, DecompYaz0 = determineCompressionMethod()
+
+# Index of the sprites resources, compiled from the xml on first use
+SpriteResources = None
+
+# NumPy only pays off for sprite blocks with more sprites than this
+NumPySpriteCount = 64
+
+
+def getSpriteIDs(spritedata):
+    """
+    Get the ids of the sprites in a sprite block as an array,
+    and the set of the different ids
+    """
+    count = len(spritedata) // 24
+
+    if np is not None and count > NumPySpriteCount:
+        ids = np.frombuffer(spritedata, dtype='>u2', count=count * 12)[::12]
+        return array('H', ids.astype(np.uint16).tobytes()), set(np.unique(ids).tolist())
+
+    ids = array('H', [data[0] for data in struct.iter_unpack('>H22x', spritedata[:count * 24])])
+    return ids, set(ids)
+
+
+def compileSpriteResources(xmlname):
+    """
+    Compile the sprites resources xml into a list of resource names
+    indexed by sprite id and a dict of resource name -> md5
+    """
+    tree = etree.parse(xmlname)
+    root = tree.getroot()
+
+    # Get all sprites' filenames and add them to a tuple
+    sprites_xml = {}
+    md5s = {}
+    names = {}
+    for sprite in root.iter('sprite'):
+        id = int(sprite.get('id'))
+
+        name = []
+        for id2 in sprite:
+            # Use one string object per resource name to keep the index compact
+            resource = names.setdefault(id2.get('name'), id2.get('name'))
+            name.append(resource)
+            md5s[resource] = id2.get('md5', '')
+
+        sprites_xml[id] = tuple(name)
+
+    sprites = [()] * (max(sprites_xml, default=-1) + 1)
+    for id in sprites_xml:
+        sprites[id] = sprites_xml[id]
+
+    return sprites, md5s
+
+
+def getSpriteResources():
+    """
+    Get the compiled sprites resources index, shared by all the levels.
+    The index is cached on disk, keyed by the md5 of the xml.
+    """
+    global SpriteResources
+
+    if SpriteResources is None:
+        xmlname = os.path.join(globals.curr_path, 'spriteresources.xml')
+        entry = ''
+
+        if globals.cachepath:
+            entry = os.path.join(globals.cachepath, 'spriteresources.%s.pickle' % hashFile(xmlname))
+
+            data = readCacheFile(entry)
+            if data is not None:
+                try:
+                    SpriteResources = pickle.loads(data)
+
+                except Exception:
+                    pass
+
+        if SpriteResources is None:
+            SpriteResources = compileSpriteResources(xmlname)
+
+            if entry:
+                writeCacheFile(entry, pickle.dumps(SpriteResources, pickle.HIGHEST_PROTOCOL))
+
+                # Forget the indexes of the older versions of the xml
+                for name in listdir(globals.cachepath):
+                    if name.startswith('spriteresources.') and name.endswith('.pickle') and name != os.path.basename(entry):
+                        try:
+                            os.remove(os.path.join(globals.cachepath, name))
+
+                        except OSError:
+                            pass
+
+    return SpriteResources
+
+
+def getResourceNames(spriteIDs):
+    """
+    Get the names of the resources needed by the sprites with the given ids
+    """
+    sprites_xml, _ = getSpriteResources()
+
+    # Sort the filenames for each "used" sprite
+    sprites_names = []
+    for sprite in spriteIDs:
+        if sprite >= len(sprites_xml):
+            continue
+
+        for sprite_name in sprites_xml[sprite]:
+            sprites_names.append(sprite_name)
+
+    return tuple(set(sprites_names))
 
 
 class Area:
@@ -48,12 +166,24 @@ class Area:
 
         self.blocks = [b''] * 15
 
-        self.tileset0 = ''
-        self.tileset1 = ''
-        self.tileset2 = ''
-        self.tileset3 = ''
+    def __getattr__(self, name):
+        # The tileset names and sprites are only parsed when first used
+        if name in ('tileset0', 'tileset1', 'tileset2', 'tileset3'):
+            if self.course is None:
+                return ''
+
+            self.LoadTilesetNames()
+
+        elif name in ('sprites', 'spriteIDs'):
+            if self.course is None:
+                return array('H') if name == 'sprites' else set()
+
+            self.LoadSprites()
+
+        else:
+            raise AttributeError(name)
 
-        self.sprites = []
+        return self.__dict__[name]
 
     def load(self, course, L0, L1, L2):
         self.course = course
@@ -61,12 +191,14 @@ class Area:
         self.L1 = L1
         self.L2 = L2
         self.LoadBlocks(course)
-        self.LoadTilesetNames()
-        self.LoadSprites()
 
     def LoadBlocks(self, course):
+        """
+        Get the blocks as views of the course file, without copying them
+        """
         self.blocks = [b''] * 15
         getblock = struct.Struct('>II')
+        view = memoryview(course)
 
         for i in range(15):
             data = getblock.unpack_from(course, i * 8)
@@ -74,10 +206,14 @@ class Area:
             if data[1] == 0:
                 self.blocks[i] = b''
             else:
-                self.blocks[i] = course[data[0]:data[0] + data[1]]
+                self.blocks[i] = view[data[0]:data[0] + data[1]]
 
         self.block1pos = getblock.unpack_from(course, 0)
 
+        # Parse them again from the new blocks when used
+        for name in ('tileset0', 'tileset1', 'tileset2', 'tileset3', 'sprites', 'spriteIDs'):
+            self.__dict__.pop(name, None)
+
     def LoadTilesetNames(self):
         data = struct.unpack_from('32s32s32s32s', self.blocks[0])
         self.tileset0 = bytes_to_string(data[0])
@@ -86,20 +222,7 @@ class Area:
         self.tileset3 = bytes_to_string(data[3])
 
     def LoadSprites(self):
-        spritedata = self.blocks[7]
-        sprcount = len(spritedata) // 24
-        sprstruct = struct.Struct('>HHH10sxx2sxxxx')
-        offset = 0
-        sprites = []
-
-        unpack = sprstruct.unpack_from
-        append = sprites.append
-        for i in range(sprcount):
-            data = unpack(spritedata, offset)
-            append(data[0])
-            offset += 24
-
-        self.sprites = sprites
+        self.sprites, self.spriteIDs = getSpriteIDs(self.blocks[7])
 
 
 class Level:
@@ -191,67 +314,44 @@ class Level:
 
         return True
 
-    def addSpriteFiles(self):
-        # Read the sprites resources xml
-        tree = etree.parse(os.path.join(globals.curr_path, 'spriteresources.xml'))
-        root = tree.getroot()
-
-        # Get all sprites' filenames and add them to a tuple
-        sprites_xml = {}
-        for sprite in root.iter('sprite'):
-            id = int(sprite.get('id'))
-
-            name = []
-            for id2 in sprite:
-                name.append(id2.get('name'))
-
-            sprites_xml[id] = tuple(name)
-
-        # Look up every sprite used in each area
-        sprites_SARC = []
+    def getSpriteIDs(self):
+        """
+        Get the ids of the sprites used in this level
+        """
+        sprites_SARC = set()
         for area_SARC in self.areas:
-            for sprite in area_SARC.sprites:
-                sprites_SARC.append(sprite)
+            sprites_SARC |= area_SARC.spriteIDs
 
-        sprites_SARC = tuple(set(sprites_SARC))
+        return sprites_SARC
 
-        # Sort the filenames for each "used" sprite
-        sprites_names = []
-        for sprite in sprites_SARC:
-            for sprite_name in sprites_xml[sprite]:
-                sprites_names.append(sprite_name)
+    def getSpriteNames(self):
+        """
+        Get the names of the resources needed by the sprites used in this level
+        """
+        return getResourceNames(self.getSpriteIDs())
 
-        sprites_names = tuple(set(sprites_names))
+    def addSpriteFiles(self):
+        _, md5s = getSpriteResources()
+        sprites_names = self.getSpriteNames()
 
         # Look up each needed file and add it to our archive
         for sprite_name in sprites_names:
             if sprite_name not in self.szsData:
-                # Get it if it has been cached
-                if sprite_name in globals.SpriteCache:
-                    self.szsData[sprite_name] = globals.SpriteCache[sprite_name]
+                # Get it from the sprite cache, or else the actor folder from the game files
+                data = loadSprite(sprite_name, md5s.get(sprite_name))
 
-                # Get it from the actor folder from the game files
-                elif os.path.isfile(os.path.join(globals.gamepath, 'Common/actor/%s.szs' % sprite_name)):
-                    with open(os.path.join(globals.gamepath, 'Common/actor/%s.szs' % sprite_name), 'rb') as inf:
-                        inb = inf.read()
-
-                    data = DecompYaz0(inb)
+                if data is not None:
                     self.szsData[sprite_name] = data
-                    globals.SpriteCache[sprite_name] = data
-
-                    del inb
-                    del data
 
                 # Throw a warning because the file was not found...
                 else:
                     print("WARNING: Could not find the file: %s" % sprite_name)
                     print("Expect the level to crash ingame...")
 
-    def save(self):
-        arc = SarcLib.SARC_Archive()
-        self.addSpriteFiles()
-
-        # Look up every tileset used in each area
+    def getTilesetNames(self):
+        """
+        Get the names of the tilesets used in this level
+        """
         tilesets_names = []
         for area_SARC in self.areas:
             if area_SARC.tileset0 not in ('', None):
@@ -266,14 +366,21 @@ class Level:
             if area_SARC.tileset3 not in ('', None):
                 tilesets_names.append(area_SARC.tileset3)
 
-        tilesets_names = tuple(set(tilesets_names))
+        return tuple(set(tilesets_names))
+
+    def save(self):
+        arc = SarcLib.SARC_Archive()
+        self.addSpriteFiles()
+
+        tilesets_names = self.getTilesetNames()
 
         # Add each tileset to our archive
         for tileset_name in tilesets_names:
             if tileset_name not in self.szsData:
-                if os.path.isfile(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % tileset_name)):
-                    with open(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % tileset_name), "rb") as inf:
-                        self.szsData[tileset_name] = DecompYaz0(inf.read())
+                data = loadTileset(tileset_name)
+
+                if data is not None:
+                    self.szsData[tileset_name] = data
 
                 else:
                     print("Tileset %s not found!" % tileset_name)
@@ -21,12 +21,20 @@
 ################################################################
 ################################################################
 
+import argparse
+from collections import deque
+import json
+import math
+import mmap
 import os
 import platform
 import shutil
 import struct
 import sys
-from zipfile import ZipFile as zf
+import tempfile
+import time
+import tracemalloc
+from zipfile import BadZipFile, ZipFile as zf
 
 if platform.system() not in ['Windows', 'Linux', 'Darwin']:
     raise NotImplementedError("Unsupported platform!")
@@ -47,12 +55,24 @@ else:
     globals.cython_available = True
 
 from bflim import writeFLIM
-from level import Level
+from cache import cacheActor, loadCompressed, loadLayout, pruneActors, pruneTilesets, spriteCache, storeCompressed, tilesetCache, trimCompressed
+from dependencies import DependencyIndex, getLevelActors, getLevelDependencies
+from level import Level, getSpriteResources
+from manifest import BuildManifest, hashData, hashFile, statFile
+from report import BuildReport, addItem, measureItem, measureStage, recordCompression
+from scheduler import Scheduler
 import SarcLib
+from workers import runJobs
 from xmltodict import XmlToDict
 
-from yaz0 import determineCompressionMethod
-CompYaz0, DecompYaz0 = determineCompressionMethod()
+from yaz0 import Presets, WSZSTBatch, determineCompressionMethod, getWSZSTBatchSize, useWSZST
+CompYaz0, _ = determineCompressionMethod()
+
+# Rough memory needed for patching a layout, relative to its decompressed size:
+# the compressed and decompressed archive, the parsed archive and the new archive
+LayoutMemoryFactor = 4
+
+SoundArchive = 'content/CAFE/sound/cafe_redpro_sound.bfsar'
 
 
 def createPatchFolder():
@@ -63,6 +83,10 @@ def createPatchFolder():
         os.mkdir(globals.patchpath)
 
     except FileExistsError:
+        if globals.incremental:
+            print("\"Patch\" folder was found, only the outdated files will be rebuilt!")
+            return
+
         clear = input("\"Patch\" folder was found and has to be deleted, do you want to continue? (Y/N):\t").lower()
         if clear == 'y':
             shutil.rmtree(globals.patchpath)
@@ -77,51 +101,228 @@ def createPatchFolder():
         print("\"Patch\" folder has successfully been created!")
 
 
-def packLevels():
+def compressFile(data, outf):
     """
-    Pack all the levels in the Stage folder
+    Compress the data straight into outf with the selected preset,
+    recording it for the report. If the same data was compressed
+    before, the output is taken from the compressed SZS store.
+    Big files are queued for WSZST instead if libyaz0 isn't available.
     """
-    if not os.path.isdir(os.path.join(globals.patchpath, 'content/Common/course_res_pack')):
-        os.mkdir(os.path.join(globals.patchpath, 'content/Common/course_res_pack'))
+    md5 = hashData(data)
+
+    if loadCompressed(md5, outf):
+        recordCompression(len(data), os.path.getsize(outf), 0, cached=True)
+        return True
+
+    if globals.compression_queue and useWSZST(len(data)):
+        queueCompression(data, outf, md5)
+        return True
+
+    start = time.perf_counter()
+
+    if not CompYaz0(data, Presets[globals.preset], outf):
+        return False
+
+    recordCompression(len(data), os.path.getsize(outf), time.perf_counter() - start)
+    storeCompressed(md5, outf)
+
+    return True
+
+
+def queueCompression(data, outf, md5):
+    """
+    Queue the data to be compressed into outf by WSZST at the end of the build
+    """
+    name = os.path.join(globals.compression_queue, hashData(outf.encode('utf-8')))
+
+    with open(name + '.sarc', "wb") as out:
+        out.write(data)
+
+    # Written last, so that the entry is only seen once it's complete
+    with open(name + '.json', "w", encoding='utf-8') as out:
+        json.dump({"Output": outf, "MD5": md5, "Size": len(data)}, out)
+
+
+def getQueuedCompressions():
+    """
+    Get the (data file, entry) of the files queued for WSZST
+    """
+    queued = []
+    for name in sorted(os.listdir(globals.compression_queue)):
+        if name.endswith('.json'):
+            with open(os.path.join(globals.compression_queue, name), encoding='utf-8') as inf:
+                queued.append((os.path.join(globals.compression_queue, name[:-5] + '.sarc'), json.load(inf)))
+
+    return sorted(queued, key=lambda item: item[1]["Output"])
+
+
+def compressQueued(queued):
+    """
+    Compress the files queued for WSZST, in batches running at the same time
+    """
+    batch = WSZSTBatch(Presets[globals.preset])
+    for fname, entry in queued:
+        batch.addFile(fname, entry["Output"])
+
+    # The number of WSZST processes running at once
+    size = getWSZSTBatchSize(len(queued), globals.jobs)
+    jobs = min(globals.jobs, math.ceil(len(queued) / size))
+
+    start = time.perf_counter()
+    results = batch.run(globals.jobs)
+    seconds = time.perf_counter() - start
+
+    total = sum(entry["Size"] for _, entry in queued) or 1
+    failed = []
+
+    for (_, entry), compressed in zip(queued, results):
+        output = os.path.relpath(entry["Output"], globals.patchpath).replace('\\', '/')
+
+        if not compressed:
+            print('Something went wrong while compressing %s!' % output)
+            globals.manifest.discard(output)
+            failed.append(output)
+            continue
+
+        print('Compressed: ' + output)
+
+        # The files of a batch are compressed together, so share out the time
+        recordCompression(entry["Size"], os.path.getsize(entry["Output"]), seconds * entry["Size"] / total, jobs=jobs)
+        storeCompressed(entry["MD5"], entry["Output"])
+
+    if failed:
+        print('\nFailed to compress: ' + ', '.join(failed))
+
+
+def getLevelInputs(entry):
+    """
+    Get the inputs a level is built from, for the build manifest,
+    from its entry in the dependency index
+    """
+    inputs = {
+        "Version": globals.version,
+        "Preset": globals.preset,
+        "Level": entry["Level"],
+    }
+
+    for name in entry["Tilesets"]:
+        inputs["Tileset/" + name] = hashFile(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % name))
+
+    for name in getLevelActors(entry):
+        inputs["Actor/" + name] = statFile(os.path.join(globals.gamepath, 'Common/actor/%s.szs' % name))
+
+    return inputs
+
+
+def packLevel(f):
+    """
+    Pack a single level from the Stage folder.
+    Returns the inputs of the level for the build manifest and its entry
+    in the dependency index, False if packing failed or None if the file
+    is not a level archive.
+    """
+    fpath = os.path.join(globals.mod_path, 'Stage/' + f)
+    lvlName = f[:-4]
+    output = 'content/Common/course_res_pack/%s.szs' % lvlName
+    md5 = hashFile(fpath)
+
+    # No need to load the level to know it's up to date if it's in the index
+    entry = globals.dependencies.get(f, md5)
+    if globals.incremental and entry is not None:
+        inputs = getLevelInputs(entry)
+        if not globals.manifest.isStale(output, inputs):
+            print('\nUp to date: ' + lvlName)
+            return inputs, entry
+
+    with zf(fpath) as lvlZip:
+        files = {name: lvlZip.read(name) for name in lvlZip.namelist()}
+
+    if lvlName not in files:
+        return None
+
+    level = Level(lvlName)
+    if not level.load(files):
+        print('%s is not a valid level archive!' % f)
+
+    entry = getLevelDependencies(md5, level)
+    inputs = getLevelInputs(entry)
+    if globals.incremental and not globals.manifest.isStale(output, inputs):
+        print('\nUp to date: ' + lvlName)
+        return inputs, entry
+
+    print('\nPacking: ' + lvlName)
+
+    levelData = level.save()
+
+    if not levelData:
+        print('Something went wrong while packing %s!' % lvlName)
+        return False
+
+    print('Compressing: ' + lvlName)
+
+    if not compressFile(levelData, os.path.join(globals.patchpath, output)):
+        print('Something went wrong while compressing %s!' % lvlName)
+        return False
+
+    print('Packed: ' + lvlName)
+
+    return inputs, entry
+
 
-    for f in os.listdir(os.path.join(globals.mod_path, 'Stage')):
+def getLevels():
+    """
+    Get the level archives in the Stage folder
+    """
+    levels = []
+    for f in sorted(os.listdir(os.path.join(globals.mod_path, 'Stage'))):
         fpath = os.path.join(globals.mod_path, 'Stage/' + f)
         if os.path.isfile(fpath) and f[-4:] == ".zip":
-            with zf(fpath) as lvlZip:
-                files = {name: lvlZip.read(name) for name in lvlZip.namelist()}
+            levels.append(f)
 
-            lvlName = f[:-4]
+    return levels
 
-            if lvlName not in files:
-                continue
 
-            print('\nPacking: ' + lvlName)
+def levelPacked(f, packed, output, error):
+    """
+    Print the output of packing a level and record it in the build manifest
+    and the dependency index. Returns False if packing it failed.
+    """
+    print(output, end='')
 
-            level = Level(lvlName)
-            if not level.load(files):
-                print('%s is not a valid level archive!' % f)
+    if error:
+        print('\nSomething went wrong while packing %s!' % f[:-4])
+        print(error, end='')
 
-            levelData = level.save()
+    output = 'content/Common/course_res_pack/%s.szs' % f[:-4]
 
-            if not levelData:
-                print('Something went wrong while packing %s!' % lvlName)
+    if error or packed is False:
+        globals.manifest.discard(output)
+        return False
 
-            else:
-                with open(os.path.join(globals.patchpath, 'content/Common/course_res_pack/' + lvlName), "wb+") as out:
-                    out.write(levelData)
+    elif packed:
+        inputs, entry = packed
+        globals.manifest.update(output, inputs)
+        globals.dependencies.update(f, entry)
 
-            print('Compressing: ' + lvlName)
+    return True
 
-            if not CompYaz0(
-                    os.path.join(globals.patchpath, 'content/Common/course_res_pack/'+ lvlName),
-                    os.path.join(globals.patchpath, 'content/Common/course_res_pack/%s.szs' % lvlName),
-            ):
-                print('Something went wrong while compressing %s!' % lvlName)
 
-            else:
-                print('Packed: ' + lvlName)
+def packLevels():
+    """
+    Pack all the levels in the Stage folder
+    """
+    if not os.path.isdir(os.path.join(globals.patchpath, 'content/Common/course_res_pack')):
+        os.mkdir(os.path.join(globals.patchpath, 'content/Common/course_res_pack'))
 
-            os.remove(os.path.join(globals.patchpath, 'content/Common/course_res_pack/' + lvlName))
+    failed = []
+    for f, packed, output, error, metrics in runJobs(packLevel, getLevels()):
+        addItem(f[:-4], metrics)
+
+        if not levelPacked(f, packed, output, error):
+            failed.append(f[:-4])
+
+    if failed:
+        print('\nFailed to pack: ' + ', '.join(failed))
 
 
 def addFileToLayout(arc, folderName, name, data):
@@ -157,184 +358,263 @@ def addFileToLayout(arc, folderName, name, data):
     return arc
 
 
-def patchLayouts():
+def getLayoutInputs(layout):
     """
-    Patch all the layouts
+    Get the inputs a layout is built from, for the build manifest
     """
-    if not os.path.isdir(os.path.join(globals.patchpath, 'content/Common/layout')):
-        os.mkdir(os.path.join(globals.patchpath, 'content/Common/layout'))
+    inputs = {
+        "Version": globals.version,
+        "Preset": globals.preset,
+        "Base": statFile(os.path.join(globals.gamepath, 'Common/layout/%s.szs' % layout)),
+    }
 
-    for layout in globals.Layouts:
-        if os.path.isdir(os.path.join(globals.mod_path, 'Layouts/' + layout)):
-            if not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/settings.xml' % layout)):
-                continue
+    folder = os.path.join(globals.mod_path, 'Layouts/' + layout)
+    for name in sorted(os.listdir(folder)):
+        if os.path.isfile(os.path.join(folder, name)):
+            inputs["File/" + name] = hashFile(os.path.join(folder, name))
 
-            settings = XmlToDict(os.path.join(globals.mod_path, 'Layouts/%s/settings.xml' % layout))
+    return inputs
 
-            if not settings:
-                continue
 
-            imgsSettings = []
-            lans = []
-            lyts = []
+def patchLayout(layout):
+    """
+    Patch a single layout.
+    Returns the inputs of the layout for the build manifest, False if
+    patching failed or None if there is nothing to patch.
+    """
+    if not os.path.isdir(os.path.join(globals.mod_path, 'Layouts/' + layout)):
+        return None
 
-            for setting in settings:
-                if settings[setting]:
-                    if setting[:3] == "Img":
-                        imgsSettings.append(settings[setting])
+    if not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/settings.xml' % layout)):
+        return None
 
-                    elif setting[:3] == "Lan":
-                        if "Name" not in settings[setting]:
-                            continue
+    settings = XmlToDict(os.path.join(globals.mod_path, 'Layouts/%s/settings.xml' % layout))
 
-                        name = settings[setting]["Name"]
+    if not settings:
+        return None
 
-                        if not name.endswith(".bflan"):
-                            continue
+    imgsSettings = []
+    lans = []
+    lyts = []
 
-                        elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
-                            continue
+    for setting in settings:
+        if settings[setting]:
+            if setting[:3] == "Img":
+                imgsSettings.append(settings[setting])
 
-                        lans.append(name)
+            elif setting[:3] == "Lan":
+                if "Name" not in settings[setting]:
+                    continue
 
-                    elif setting[:3] == "Lyt":
-                        if "Name" not in settings[setting]:
-                            continue
+                name = settings[setting]["Name"]
 
-                        name = settings[setting]["Name"]
+                if not name.endswith(".bflan"):
+                    continue
 
-                        if not name.endswith(".bflyt"):
-                            continue
+                elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
+                    continue
 
-                        elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
-                            continue
+                lans.append(name)
 
-                        lyts.append(name)
+            elif setting[:3] == "Lyt":
+                if "Name" not in settings[setting]:
+                    continue
 
-            if not (imgsSettings or lans or lyts):
-                continue
+                name = settings[setting]["Name"]
 
-            imgs = {}
-            for imgSettings in imgsSettings:
-                name = ""
-                bflimname = ""
-                tileMode = 4
-                swizzle = 0
-                SRGB = "False"
+                if not name.endswith(".bflyt"):
+                    continue
 
-                for setting in imgSettings:
-                    if setting == "Name":
-                        name = imgSettings[setting]
+                elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
+                    continue
 
-                    elif setting == "BFLIMName":
-                        bflimname = imgSettings[setting]
+                lyts.append(name)
 
-                    elif imgSettings[setting]:
-                        if setting == "TileMode":
-                            try:
-                                tileMode = int(imgSettings[setting], 0)
+    if not (imgsSettings or lans or lyts):
+        return None
 
-                            except ValueError:
-                                tileMode = 4
+    output = 'content/Common/layout/%s.szs' % layout
+    inputs = getLayoutInputs(layout)
 
-                            else:
-                                if tileMode > 16 or tileMode < 0:
-                                    tileMode = 4
+    if globals.incremental and not globals.manifest.isStale(output, inputs):
+        print("\nUp to date: %s.szs" % layout)
+        return inputs
 
-                        elif setting == "Swizzle":
-                            try:
-                                swizzle = int(imgSettings[setting], 0)
+    imgs = {}
+    for imgSettings in imgsSettings:
+        name = ""
+        bflimname = ""
+        tileMode = 4
+        swizzle = 0
+        SRGB = "False"
 
-                            except ValueError:
-                                swizzle = 0
+        for setting in imgSettings:
+            if setting == "Name":
+                name = imgSettings[setting]
 
-                            else:
-                                if swizzle > 7 or swizzle < 0:
-                                    swizzle = 0
+            elif setting == "BFLIMName":
+                bflimname = imgSettings[setting]
 
-                        elif setting == "SRGB":
-                            SRGB = imgSettings[setting]
-                            if SRGB not in ["True", "False"]:
-                                SRGB = "False"
+            elif imgSettings[setting]:
+                if setting == "TileMode":
+                    try:
+                        tileMode = int(imgSettings[setting], 0)
 
-                if not name:
-                    continue
+                    except ValueError:
+                        tileMode = 4
 
-                elif not name.endswith(".dds"):
-                    continue
+                    else:
+                        if tileMode > 16 or tileMode < 0:
+                            tileMode = 4
 
-                elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
-                    continue
+                elif setting == "Swizzle":
+                    try:
+                        swizzle = int(imgSettings[setting], 0)
 
-                if not bflimname:
-                    bflimname = name[:-3] + "bflim"
+                    except ValueError:
+                        swizzle = 0
 
-                data = writeFLIM(
-                    os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)),
-                    tileMode, swizzle,
-                    SRGB == "True",
-                )
+                    else:
+                        if swizzle > 7 or swizzle < 0:
+                            swizzle = 0
 
-                if not data:
-                    print("Something went wrong while converting %s to BFLIM!" % name)
-                    continue
+                elif setting == "SRGB":
+                    SRGB = imgSettings[setting]
+                    if SRGB not in ["True", "False"]:
+                        SRGB = "False"
 
-                imgs[name] = {
-                    "BFLIMName": bflimname,
-                    "Data": data,
-                }
+        if not name:
+            continue
 
-            print("\nPatching: %s.szs\n" % layout)
+        elif not name.endswith(".dds"):
+            continue
 
-            szsname = os.path.join(globals.gamepath, 'Common/layout/%s.szs' % layout)
+        elif not os.path.isfile(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name))):
+            continue
 
-            if not os.path.isfile(szsname):
-                print('Something went wrong while reading %s.szs!' % layout)
-                continue
+        if not bflimname:
+            bflimname = name[:-3] + "bflim"
 
-            else:
-                with open(szsname, 'rb') as inf:
-                    inb = inf.read()
+        data = writeFLIM(
+            os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)),
+            tileMode, swizzle,
+            SRGB == "True",
+        )
 
-            arc = SarcLib.SARC_Archive(DecompYaz0(inb))
-            for name in imgs:
-                bflimname = imgs[name]["BFLIMName"]
-                data = imgs[name]["Data"]
+        if not data:
+            print("Something went wrong while converting %s to BFLIM!" % name)
+            continue
 
-                arc = addFileToLayout(arc, "timg", bflimname, data)
+        imgs[name] = {
+            "BFLIMName": bflimname,
+            "Data": data,
+        }
 
-            for name in lans:
-                with open(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)), "rb") as inf:
-                    data = inf.read()
+    print("\nPatching: %s.szs\n" % layout)
 
-                arc = addFileToLayout(arc, "anim", name, data)
+    data = loadLayout(layout)
 
-            for name in lyts:
-                with open(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)), "rb") as inf:
-                    data = inf.read()
+    if not data:
+        print('Something went wrong while reading %s.szs!' % layout)
+        return False
 
-                arc = addFileToLayout(arc, "blyt", name, data)
+    try:
+        arc = SarcLib.SARC_Archive(data)
 
-            with open(os.path.join(globals.patchpath, 'content/Common/layout/%s.sarc' % layout), "wb+") as out:
-                out.write(arc.save()[0])
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
 
-            print('\nCompressing: %s.szs' % layout)
+    for name in imgs:
+        bflimname = imgs[name]["BFLIMName"]
+        data = imgs[name]["Data"]
 
-            if not CompYaz0(
-                    os.path.join(globals.patchpath, 'content/Common/layout/%s.sarc' % layout),
-                    os.path.join(globals.patchpath, 'content/Common/layout/%s.szs' % layout),
-            ):
-                print('Something went wrong while compressing %s.szs!' % layout)
+        arc = addFileToLayout(arc, "timg", bflimname, data)
 
-            else:
-                print('Patched: %s.szs' % layout)
+    for name in lans:
+        with open(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)), "rb") as inf:
+            data = inf.read()
+
+        arc = addFileToLayout(arc, "anim", name, data)
+
+    for name in lyts:
+        with open(os.path.join(globals.mod_path, 'Layouts/%s/%s' % (layout, name)), "rb") as inf:
+            data = inf.read()
+
+        arc = addFileToLayout(arc, "blyt", name, data)
+
+    print('\nCompressing: %s.szs' % layout)
+
+    if not compressFile(arc.save()[0], os.path.join(globals.patchpath, 'content/Common/layout/%s.szs' % layout)):
+        print('Something went wrong while compressing %s.szs!' % layout)
+        return False
+
+    print('Patched: %s.szs' % layout)
+
+    return inputs
+
+
+def getLayoutCost(layout):
+    """
+    Estimate the memory needed for patching a layout
+    from the decompressed size of its SZS
+    """
+    try:
+        with open(os.path.join(globals.gamepath, 'Common/layout/%s.szs' % layout), 'rb') as inf:
+            header = inf.read(8)
+
+    except OSError:
+        return 0
+
+    if len(header) < 8 or header[:4] != b'Yaz0':
+        return 0
+
+    return struct.unpack('>I', header[4:8])[0] * LayoutMemoryFactor
+
+
+def layoutPatched(layout, patched, output, error):
+    """
+    Print the output of patching a layout and record it in the build manifest.
+    Returns False if patching it failed.
+    """
+    print(output, end='')
+
+    if error:
+        print('\nSomething went wrong while patching %s.szs!' % layout)
+        print(error, end='')
+
+    if error or patched is False:
+        globals.manifest.discard('content/Common/layout/%s.szs' % layout)
+        return False
+
+    elif patched:
+        globals.manifest.update('content/Common/layout/%s.szs' % layout, patched)
+
+    return True
+
+
+def patchLayouts():
+    """
+    Patch all the layouts
+    """
+    if not os.path.isdir(os.path.join(globals.patchpath, 'content/Common/layout')):
+        os.mkdir(os.path.join(globals.patchpath, 'content/Common/layout'))
+
+    failed = []
+    for layout, patched, output, error, metrics in runJobs(patchLayout, list(globals.Layouts)):
+        addItem(layout, metrics)
 
-            os.remove(os.path.join(globals.patchpath, 'content/Common/layout/%s.sarc' % layout))
+        if not layoutPatched(layout, patched, output, error):
+            failed.append(layout)
+
+    if failed:
+        print('\nFailed to patch: ' + ', '.join('%s.szs' % layout for layout in failed))
 
 
 def patchBFSAR():
     """
-    Patch the Sound Archive
+    Patch the Sound Archive.
+    Returns its inputs for the build manifest, or None if it isn't patched.
     """
     if not os.path.isdir(os.path.join(globals.patchpath, 'content/CAFE/sound')):
         os.mkdir(os.path.join(globals.patchpath, 'content/CAFE/sound'))
@@ -343,15 +623,17 @@ def patchBFSAR():
     if not os.path.isfile(fsar):
         print("\n\"cafe_redpro_sound.bfsar\" not found!")
         print("Skipping patching the Sound Archive...")
-        return
+        return None
 
     tracks = {}
     for track in globals.Tracks:
-        if not os.path.isfile(os.path.join(globals.mod_path, 'Sound/%s.bfwav' % track)):
+        fwav = os.path.join(globals.mod_path, 'Sound/%s.bfwav' % track)
+        if not os.path.isfile(fwav):
             continue
 
-        with open(os.path.join(globals.mod_path, 'Sound/%s.bfwav' % track), "rb") as inf:
-            data = inf.read()
+        # Only the header is needed for now, the track is read when injecting it
+        with open(fwav, "rb") as inf:
+            data = inf.read(16)
 
         if data[:4] != b'FWAV':
             continue
@@ -368,49 +650,101 @@ def patchBFSAR():
             print("Invalid endianness in \"%s.bfwav\"!" % track)
             continue
 
-        size2 = len(data)
+        size2 = os.path.getsize(fwav)
         size3 = struct.unpack(endianness + "I", data[12:16])[0]
 
         if size2 > size or size3 > size:
             print("Size of \"%s.bfwav\" exceeds the original!" % track)
             continue
 
-        tracks[track] = (data, pos, size2)
+        tracks[track] = (fwav, pos, size2)
 
-    if tracks:
-        with open(fsar, "rb") as inf:
-            fsarData = inf.read()
+    if not tracks:
+        return None
 
-        if fsarData[:4] != b'FSAR':
-            print("Invalid Sound Archive!")
-            print("Skipping patching the Sound Archive...")
-            return
+    inputs = {
+        "Version": globals.version,
+        "Base": statFile(fsar),
+    }
+
+    for track in tracks:
+        inputs["Track/" + track] = hashFile(tracks[track][0])
+
+    if globals.incremental and not globals.manifest.isStale(SoundArchive, inputs):
+        print("Up to date: cafe_redpro_sound.bfsar")
+        return inputs
+
+    with open(fsar, "rb") as inf:
+        magic = inf.read(4)
+
+    if magic != b'FSAR':
+        print("Invalid Sound Archive!")
+        print("Skipping patching the Sound Archive...")
+        return None
+
+    # Copy the archive as is (done by the kernel where supported)
+    # and only overwrite the ranges of the injected tracks
+    outname = os.path.join(globals.patchpath, SoundArchive)
+    shutil.copyfile(fsar, outname)
 
-        for track in tracks:
-            fwavData, pos, size = tracks[track]
+    with open(outname, "r+b") as outf:
+        for track in sorted(tracks, key=lambda track: tracks[track][1]):
+            fwav, pos, size = tracks[track]
 
             print("Injecting: " + track)
 
-            if not isinstance(fsarData, bytearray):
-                fsarData = bytearray(fsarData)
+            with measureItem(track):
+                with open(fwav, "rb") as inf:
+                    fwavData = inf.read()
+
+                outf.seek(pos)
+                outf.write(fwavData)
+
+                del fwavData
+
+    return inputs
+
+
+def soundArchivePatched(patched, output, error):
+    """
+    Print the output of patching the Sound Archive and record it in the build manifest
+    """
+    print(output, end='')
 
-            fsarData[pos:pos + size] = fwavData
+    if error:
+        print('\nSomething went wrong while patching the Sound Archive!')
+        print(error, end='')
 
-        with open(os.path.join(globals.patchpath, 'content/CAFE/sound/cafe_redpro_sound.bfsar'), "wb+") as outf:
-            outf.write(fsarData)
+    if patched:
+        globals.manifest.update(SoundArchive, patched)
 
 
-def copytree(src, dst):
+def getFilesToCopy(src, dst):
+    """
+    Get the (source, destination) of each file in src that is newer than in dst
+    """
     # https://stackoverflow.com/a/13814557
+    files = []
     for item in os.listdir(src):
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if os.path.isdir(s):
-            copytree(s, d)
+            files += getFilesToCopy(s, d)
 
         else:
             if not os.path.exists(d) or os.stat(s).st_mtime - os.stat(d).st_mtime > 1:
-                shutil.copy2(s, d)
+                files.append((s, d))
+
+    return files
+
+
+def copyFile(files):
+    s, d = files
+    shutil.copy2(s, d)
+
+
+def getCopyName(files):
+    return os.path.relpath(files[1], globals.patchpath).replace('\\', '/')
 
 
 def getTree_(src, src2):
@@ -431,7 +765,11 @@ def getTree(src):
             getTree_(src, dir_)
 
 
-def copyOtherFiles():
+def getOtherFiles():
+    """
+    Create the folders of the other files in the Patch folder
+    and get the files that have to be copied there
+    """
     globals.Tree = []
 
     getTree(os.path.join(globals.curr_path, 'Files/Other'))
@@ -440,15 +778,251 @@ def copyOtherFiles():
         if not os.path.exists(dir):
             os.mkdir(dir)
 
-    copytree(os.path.join(globals.curr_path, 'Files/Other'), globals.patchpath)
+    return getFilesToCopy(os.path.join(globals.curr_path, 'Files/Other'), globals.patchpath)
+
+
+def copyOtherFiles():
+    for files in getOtherFiles():
+        with measureItem(getCopyName(files)):
+            copyFile(files)
+
+
+def runStep(step):
+    """
+    Run a step that isn't split into smaller tasks
+    """
+    return step()
+
+
+def scanLevel(f):
+    """
+    Get the entry of a level in the dependency index, or None if it isn't
+    a level archive. The level is only loaded if it changed since it was indexed.
+    """
+    fpath = os.path.join(globals.mod_path, 'Stage/' + f)
+    md5 = hashFile(fpath)
+
+    entry = globals.dependencies.get(f, md5)
+    if entry is not None:
+        return entry
+
+    try:
+        with zf(fpath) as lvlZip:
+            files = {name: lvlZip.read(name) for name in lvlZip.namelist()}
+
+    except (BadZipFile, OSError):
+        return None
+
+    if f[:-4] not in files:
+        return None
+
+    level = Level(f[:-4])
+    try:
+        level.load(files)
+
+    except Exception:
+        return None
+
+    entry = getLevelDependencies(md5, level)
+    globals.dependencies.update(f, entry)
+
+    return entry
+
+
+def whoUses(name):
+    """
+    Print the levels using an actor or a tileset,
+    after bringing the dependency index up to date
+    """
+    levels = getLevels()
+    for f in levels:
+        if scanLevel(f) is None:
+            print("Skipped: %s is not a readable level archive" % f)
+
+    globals.dependencies.prune(levels)
+    globals.dependencies.save()
+
+    users = globals.dependencies.whoUses(name)
+    if not users:
+        print("No level uses %s" % name)
+        return
+
+    print("Levels using %s:" % name)
+    for level, kind in users:
+        print("  %s (%s)" % (level, kind))
+
+
+def getFileSize(fname):
+    try:
+        return os.path.getsize(fname)
+
+    except OSError:
+        return 0
+
+
+def buildScheduled():
+    """
+    Run all the steps at once, as a graph of tasks on a shared pool of worker processes.
+    The levels to rebuild depend on the tasks that put the actors they need in the disk cache.
+    The weights of the tasks are the sizes of the data they process.
+    """
+    os.makedirs(os.path.join(globals.patchpath, 'content/Common/course_res_pack'), exist_ok=True)
+    os.makedirs(os.path.join(globals.patchpath, 'content/Common/layout'), exist_ok=True)
+
+    scheduler = Scheduler(globals.jobs, globals.memory_budget)
+
+    _, md5s = getSpriteResources()
+    actorTasks = {}
+
+    for f in getLevels():
+        weight = getFileSize(os.path.join(globals.mod_path, 'Stage/' + f))
+        deps = []
+
+        # Only the levels in the dependency index are known without loading them,
+        # the others are loaded by their own task, which caches the actors it uses
+        entry = globals.dependencies.get(f, hashFile(os.path.join(globals.mod_path, 'Stage/' + f)))
+        if entry:
+            output = 'content/Common/course_res_pack/%s.szs' % f[:-4]
+            if globals.incremental and not globals.manifest.isStale(output, getLevelInputs(entry)):
+                actors = []
+
+            else:
+                actors = getLevelActors(entry)
+
+            for name in actors:
+                szsname = os.path.join(globals.gamepath, 'Common/actor/%s.szs' % name)
+                if name not in actorTasks and os.path.isfile(szsname):
+                    actorTasks[name] = scheduler.add('Actor/' + name, cacheActorTask, (name, md5s.get(name)),
+                                                     weight=getFileSize(szsname), group='Actors')
+
+                if name in actorTasks:
+                    deps.append(actorTasks[name])
+
+            for name in entry["Tilesets"]:
+                weight += getFileSize(os.path.join(globals.mod_path, 'Stage/Texture/%s.szs' % name))
+
+        scheduler.add(f[:-4], packLevel, f, deps, weight, group='Levels')
+
+    for layout in globals.Layouts:
+        cost = getLayoutCost(layout)
+        scheduler.add(layout, patchLayout, layout, weight=cost // LayoutMemoryFactor, cost=cost, group='Layouts')
+
+    weight = sum(getFileSize(os.path.join(globals.mod_path, 'Sound/%s.bfwav' % track)) for track in globals.Tracks)
+    scheduler.add('cafe_redpro_sound.bfsar', runStep, patchBFSAR, weight=weight, group='Sound Archive')
+
+    for files in getOtherFiles():
+        scheduler.add(getCopyName(files), copyFile, files, weight=getFileSize(files[0]), group='Other Files')
+
+    failedLevels = []
+    failedLayouts = []
+
+    # The tasks of each group are handled in the order they were added,
+    # so the output doesn't depend on which worker finishes first
+    queues = {}
+    for task in scheduler.tasks:
+        queues.setdefault(task.group, deque()).append(task)
+
+    finished = {}
+
+    for task, result, output, error, metrics in scheduler.run():
+        finished[task] = result, output, error, metrics
+
+        queue = queues[task.group]
+        while queue and queue[0] in finished:
+            task = queue.popleft()
+            result, output, error, metrics = finished.pop(task)
+
+            taskDone(task, result, output, error, metrics, failedLevels, failedLayouts)
+
+    if failedLevels:
+        print('\nFailed to pack: ' + ', '.join(failedLevels))
+
+    if failedLayouts:
+        print('\nFailed to patch: ' + ', '.join('%s.szs' % layout for layout in failedLayouts))
+
+
+def taskDone(task, result, output, error, metrics, failedLevels, failedLayouts):
+    """
+    Print the output of a finished task of the build and record its result
+    """
+    addItem(task.name, metrics, task.group)
+
+    if task.group == 'Levels':
+        if not levelPacked(task.item, result, output, error):
+            failedLevels.append(task.item[:-4])
+
+    elif task.group == 'Layouts':
+        if not layoutPatched(task.item, result, output, error):
+            failedLayouts.append(task.item)
+
+    elif task.group == 'Sound Archive':
+        soundArchivePatched(result, output, error)
+
+    else:
+        print(output, end='')
+
+        if error:
+            print('\nSomething went wrong with %s!' % task.name)
+            print(error, end='')
+
+
+def cacheActorTask(actor):
+    name, md5 = actor
+    if not cacheActor(name, md5):
+        print("Couldn't cache the actor %s, it will be decompressed by each level using it" % name)
 
 
 def main():
-    print("OtherSMBU Patcher v0.1\n(C) 2018 - AboodXD\n")
+    parser = argparse.ArgumentParser(description="OtherSMBU Patcher")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of worker processes the build runs on")
+    parser.add_argument('--memory-budget', type=int, default=1024, metavar='MB',
+                        help="memory the layouts patched at the same time may use, 0 for no limit (default: 1024)")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="keep the \"Patch\" folder and only rebuild the outdated files")
+    parser.add_argument('-c', '--compression', choices=list(Presets), default='fast',
+                        help="Yaz0 compression preset, from the fastest to the smallest output (default: fast)")
+    parser.add_argument('--tileset-cache-size', type=int, default=256, metavar='MB',
+                        help="memory each process may use for keeping the decompressed tilesets "
+                             "shared by several levels (default: 256)")
+    parser.add_argument('--sprite-cache-size', type=int, default=256, metavar='MB',
+                        help="memory each process may use for keeping the decompressed game actors "
+                             "used by the levels (default: 256)")
+    parser.add_argument('--szs-cache-size', type=int, default=512, metavar='MB',
+                        help="disk space for keeping compressed archives to reuse when their contents "
+                             "didn't change, 0 to disable (default: 512)")
+    parser.add_argument('--who-uses', metavar='NAME',
+                        help="list the levels using an actor or a tileset and exit")
+    parser.add_argument('--report', nargs='?', const='report.json', metavar='FILE',
+                        help="write the time, I/O and memory used by each step to a JSON file "
+                             "next to the \"Patch\" folder (default: report.json)")
+    parser.add_argument('--trace-malloc', action='store_true',
+                        help="also record the peak memory allocated by Python in the report (slower)")
+    args = parser.parse_args()
+
+    globals.jobs = max(1, args.jobs)
+    globals.incremental = args.incremental
+    globals.preset = args.compression
+    globals.memory_budget = max(0, args.memory_budget) * 0x100000
+    globals.szs_cache_size = max(0, args.szs_cache_size) * 0x100000
+    globals.tileset_cache_size = max(0, args.tileset_cache_size) * 0x100000
+    globals.sprite_cache_size = max(0, args.sprite_cache_size) * 0x100000
+    tilesetCache.setBudget(globals.tileset_cache_size)
+    spriteCache.setBudget(globals.sprite_cache_size)
+    globals.trace_malloc = bool(args.report) and args.trace_malloc
+
+    print("OtherSMBU Patcher v%s\n(C) 2018 - AboodXD\n" % globals.version)
 
-    globals.gamepath = input("Enter the path to the content folder of NSMBU:\t")
     globals.mod_path = os.path.join(globals.curr_path, 'Files')
     globals.patchpath = os.path.join(globals.curr_path, 'Patch')
+    globals.cachepath = os.path.join(globals.curr_path, 'Cache')
+    globals.dependencies = DependencyIndex(os.path.join(globals.cachepath, 'dependencies.json'))
+
+    if args.who_uses:
+        whoUses(args.who_uses)
+        return
+
+    globals.gamepath = input("Enter the path to the content folder of NSMBU:\t")
 
     if not globals.gamepath:
         sys.exit(1)
@@ -457,30 +1031,83 @@ def main():
         print("Folder doesn't exist!")
         sys.exit(1)
 
+    if args.report:
+        if globals.trace_malloc:
+            tracemalloc.start()
+
+        globals.report = BuildReport(os.path.join(globals.curr_path, args.report))
+
     # Step 1: Create the Patch folder
     print("\nCreating \"Patch\" folder...")
     createPatchFolder()
 
-    # Step 1.5: Create necessary folders
-    os.mkdir(os.path.join(globals.patchpath, 'content'))
-    os.mkdir(os.path.join(globals.patchpath, 'content/Common'))
-    os.mkdir(os.path.join(globals.patchpath, 'content/CAFE'))
+    globals.manifest = BuildManifest(os.path.join(globals.cachepath, 'manifest.json'))
 
-    # Step 2: Pack the levels
-    print('\nPacking the levels...')
-    packLevels()
+    # Step 1.5: Create necessary folders
+    os.makedirs(os.path.join(globals.patchpath, 'content'), exist_ok=True)
+    os.makedirs(os.path.join(globals.patchpath, 'content/Common'), exist_ok=True)
+    os.makedirs(os.path.join(globals.patchpath, 'content/CAFE'), exist_ok=True)
 
-    # Step 3: Patch the layouts
-    print('\nPatching the layouts...')
-    patchLayouts()
+    # Without libyaz0, the big archives are compressed by WSZST at the end
+    globals.compression_queue = tempfile.mkdtemp(prefix='yaz0queue')
 
-    # Step 4: Patch the Sound Archive
-    print('\nPatching the Sound Archive...\n')
-    patchBFSAR()
+    try:
+        if globals.jobs > 1:
+            # Steps 2-5 at once
+            print('\nBuilding the patch with %d jobs...' % globals.jobs)
+            with measureStage('Build'):
+                buildScheduled()
 
-    # Step 5: Copy the other files
-    print('\nCopying the other files...\n')
-    copyOtherFiles()
+        else:
+            # Step 2: Pack the levels
+            print('\nPacking the levels...')
+            with measureStage('Levels'):
+                packLevels()
+
+            # Step 3: Patch the layouts
+            print('\nPatching the layouts...')
+            with measureStage('Layouts'):
+                patchLayouts()
+
+            # Step 4: Patch the Sound Archive
+            print('\nPatching the Sound Archive...\n')
+            with measureStage('Sound Archive'):
+                soundArchivePatched(patchBFSAR(), '', None)
+
+            # Step 5: Copy the other files
+            print('\nCopying the other files...\n')
+            with measureStage('Other Files'):
+                copyOtherFiles()
+
+        # Step 6: Compress the queued archives
+        queued = getQueuedCompressions()
+        if queued:
+            print('\nCompressing %d archives with WSZST...\n' % len(queued))
+            with measureStage('Compression'):
+                compressQueued(queued)
+
+    finally:
+        shutil.rmtree(globals.compression_queue, ignore_errors=True)
+        globals.compression_queue = ''
+
+    # Remove the files that are no longer part of the patch
+    # (a full rebuild started from an empty folder, so there's nothing to report)
+    globals.manifest.prune(quiet=not globals.incremental)
+    globals.manifest.save()
+
+    globals.dependencies.prune(getLevels())
+    globals.dependencies.save()
+
+    # Keep the compressed SZS store within its size
+    trimCompressed(globals.szs_cache_size)
+
+    # Forget the old versions of the tilesets and game actors
+    pruneTilesets()
+    pruneActors()
+
+    if globals.report is not None:
+        globals.report.save()
+        print('\nReport written to ' + globals.report.path)
 
 
 if __name__ == '__main__':
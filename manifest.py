@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""manifest.py: Build manifest used for incremental builds."""
+
+import hashlib
+import json
+import os
+
+import globals
+
+ManifestVersion = 1
+
+# (path, size, mtime) -> md5, so that each file is only read once per run
+_fileHashes = {}
+
+
+def hashData(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def hashFile(path):
+    """
+    Get the md5 of a file, or '' if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+
+    except OSError:
+        return ''
+
+    key = (path, st.st_size, st.st_mtime_ns)
+    if key not in _fileHashes:
+        md5 = hashlib.md5()
+        with open(path, "rb") as inf:
+            for chunk in iter(lambda: inf.read(0x100000), b''):
+                md5.update(chunk)
+
+        _fileHashes[key] = md5.hexdigest()
+
+    return _fileHashes[key]
+
+
+def statFile(path):
+    """
+    Get the size and modification time of a file, or '' if it doesn't exist.
+    Used instead of hashFile() for big game files that never change.
+    """
+    try:
+        st = os.stat(path)
+
+    except OSError:
+        return ''
+
+    return '%d:%d' % (st.st_size, st.st_mtime_ns)
+
+
+class BuildManifest:
+    """
+    Records the hashes of the inputs each file in the Patch folder was built from
+    """
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+        self.built = set()
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as inf:
+                manifest = json.load(inf)
+
+        except (OSError, ValueError):
+            return
+
+        if manifest.get("Version") == ManifestVersion:
+            self.outputs = manifest["Outputs"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + '.tmp', "w", encoding='utf-8') as out:
+            json.dump({"Version": ManifestVersion, "Outputs": self.outputs}, out, indent=1, sort_keys=True)
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def isStale(self, output, inputs):
+        """
+        Check if an output, relative to the Patch folder, has to be rebuilt
+        """
+        if self.outputs.get(output) != inputs:
+            return True
+
+        return not os.path.isfile(os.path.join(globals.patchpath, output))
+
+    def update(self, output, inputs):
+        self.outputs[output] = inputs
+        self.built.add(output)
+
+    def discard(self, output):
+        """
+        Forget an output and remove it from the Patch folder
+        """
+        self.outputs.pop(output, None)
+        self.built.discard(output)
+
+        if os.path.isfile(os.path.join(globals.patchpath, output)):
+            os.remove(os.path.join(globals.patchpath, output))
+
+    def prune(self, quiet=False):
+        """
+        Remove the outputs that weren't built or found up to date in this run
+        """
+        for output in list(self.outputs):
+            if output not in self.built:
+                if not quiet:
+                    print("Removing: " + output)
+
+                self.discard(output)
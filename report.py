@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""report.py: Timing and memory report of a build."""
+
+from contextlib import contextmanager
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+try:
+    import resource
+
+except ImportError:
+    resource = None
+
+import addrlib
+from cache import spriteCache, tilesetCache
+import globals
+
+# The caches whose counters are part of the measurements
+Caches = {
+    "TilesetCache": tilesetCache,
+    "SpriteCache": spriteCache,
+}
+
+if addrlib.getTableCache() is not None:
+    Caches["SwizzleCache"] = addrlib.getTableCache()
+
+# The measurements currently running in this process, innermost last
+_active = []
+
+# The items measured by the job running in this worker process,
+# sent back to the main process with the metrics of the job
+_jobItems = None
+
+
+def readIO():
+    """
+    Get the bytes read and written by this process so far, or None
+    if the platform doesn't tell (only Linux has /proc/self/io)
+    """
+    try:
+        with open('/proc/self/io') as inf:
+            counters = dict(line.split(':') for line in inf)
+
+    except (OSError, ValueError):
+        return None
+
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def getPeakRSS():
+    """
+    Get the peak resident set size of this process so far, or None
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes, the others kilobytes
+    if platform.system() == 'Darwin':
+        return peak
+
+    return peak * 1024
+
+
+class Measurement:
+    """
+    Measures the wall time, CPU time, I/O and memory peaks of a block of code.
+    The CPU time includes the child processes that finished during the block.
+    PeakRSS is the peak of the whole process so far and RSSGrowth how much
+    the block raised it, so only the latter is kept for the items.
+    """
+    def __init__(self):
+        self.metrics = None
+        self.childPeak = 0
+        self.compression = None
+
+    def __enter__(self):
+        times = os.times()
+
+        self.wall = time.perf_counter()
+        self.cpu = times.user + times.system
+        self.childCpu = times.children_user + times.children_system
+        self.io = readIO()
+        self.rss = getPeakRSS()
+        self.caches = {name: cache.counters() for name, cache in Caches.items()}
+
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        _active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _active.remove(self)
+
+        times = os.times()
+        io = readIO()
+        rss = getPeakRSS()
+
+        peakTraced = None
+        if tracemalloc.is_tracing():
+            peakTraced = max(tracemalloc.get_traced_memory()[1], self.childPeak)
+
+            # Let the enclosing measurement know about the peak it can no longer see
+            if _active:
+                _active[-1].childPeak = max(_active[-1].childPeak, peakTraced)
+
+        self.metrics = {
+            "Wall": time.perf_counter() - self.wall,
+            "CPU": times.user + times.system - self.cpu + times.children_user + times.children_system - self.childCpu,
+            "Read": io[0] - self.io[0] if io and self.io else None,
+            "Written": io[1] - self.io[1] if io and self.io else None,
+            "PeakRSS": rss,
+            "RSSGrowth": rss - self.rss if rss is not None and self.rss is not None else None,
+            "PeakTraced": peakTraced,
+            "Pid": os.getpid(),
+        }
+
+        if self.compression:
+            self.metrics["Compression"] = summarizeCompression(self.compression)
+
+        for name, cache in Caches.items():
+            counters = cache.counters()
+            counters = {key: counters[key] - self.caches[name][key] for key in counters}
+
+            if counters["Hits"] or counters["Misses"]:
+                self.metrics[name] = summarizeCache(counters)
+
+        return False
+
+
+def summarizeCompression(compression):
+    """
+    Add the ratio and throughput (in MiB/s) to the totals of the compressed files
+    """
+    compression = dict(compression)
+
+    compression["Ratio"] = compression["Compressed"] / compression["Raw"] if compression["Raw"] else None
+    compression["Throughput"] = compression["Raw"] / compression["Time"] / 0x100000 if compression["Time"] else None
+
+    return compression
+
+
+def summarizeCache(counters):
+    """
+    Add the hit rate to the counters of a cache,
+    counting the misses found in the disk cache as hits
+    """
+    counters = dict(counters)
+
+    lookups = counters["Hits"] + counters["Misses"]
+    counters["HitRate"] = (counters["Hits"] + counters.get("DiskHits", 0)) / lookups if lookups else None
+
+    return counters
+
+
+def recordCompression(raw, compressed, seconds, cached=False, jobs=1):
+    """
+    Add a compressed file to the measurements running in this process.
+    cached files were taken from the compressed SZS store.
+    jobs is how many compressors were running at once.
+    """
+    for measurement in _active:
+        if measurement.compression is None:
+            measurement.compression = {"Preset": globals.preset, "Jobs": 1, "Files": 0, "Cached": 0, "Raw": 0, "Compressed": 0, "Time": 0}
+
+        measurement.compression["Jobs"] = max(measurement.compression["Jobs"], jobs)
+
+        if cached:
+            measurement.compression["Cached"] += 1
+            continue
+
+        measurement.compression["Files"] += 1
+        measurement.compression["Raw"] += raw
+        measurement.compression["Compressed"] += compressed
+        measurement.compression["Time"] += seconds
+
+
+def mergeMetrics(metrics, others):
+    """
+    Add the I/O, compression and cache counters of other
+    measurements to metrics and take the highest peaks
+    """
+    for other in others:
+        for key in "Read", "Written":
+            if other.get(key) is not None:
+                metrics[key] = (metrics.get(key) or 0) + other[key]
+
+        for key in "PeakRSS", "PeakTraced":
+            if other.get(key) is not None:
+                metrics[key] = max(metrics.get(key) or 0, other[key])
+
+        if other.get("Compression"):
+            compression = metrics.get("Compression") or {"Preset": globals.preset, "Jobs": 1, "Files": 0, "Cached": 0, "Raw": 0, "Compressed": 0, "Time": 0}
+            for key in "Files", "Cached", "Raw", "Compressed", "Time":
+                compression[key] += other["Compression"][key]
+
+            compression["Jobs"] = max(compression["Jobs"], other["Compression"].get("Jobs", 1))
+
+            metrics["Compression"] = summarizeCompression(compression)
+
+        for name in Caches:
+            if other.get(name):
+                counters = metrics.get(name) or {}
+                for key in other[name]:
+                    if key != "HitRate":
+                        counters[key] = counters.get(key, 0) + other[name][key]
+
+                metrics[name] = summarizeCache(counters)
+
+
+class Stage(Measurement):
+    """
+    A step of the build, made of items
+    """
+    def __init__(self, report, name):
+        super().__init__()
+
+        self.report = report
+        self.name = name
+        self.items = []
+
+    def __enter__(self):
+        if self.report is not None:
+            self.report.currentStage = self
+
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+
+        if self.report is None:
+            return False
+
+        self.report.currentStage = None
+
+        # The I/O and memory of the worker processes aren't seen by this one
+        # (the items measured inside a job are already part of it)
+        workers = [item for item in self.items if item["Pid"] != self.metrics["Pid"] and "Job" not in item]
+        mergeMetrics(self.metrics, workers)
+        mergeMetrics(self.report.total.workerMetrics, workers)
+
+        stage = {"Name": self.name}
+        stage.update(self.metrics)
+        del stage["RSSGrowth"]
+
+        # The peak of a process isn't the one of the item that ran in it
+        stage["Items"] = self.items
+        for item in self.items:
+            item.pop("PeakRSS", None)
+
+        self.report.stages.append(stage)
+
+        return False
+
+
+class Item(Measurement):
+    """
+    A single level, layout, track or file
+    """
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        addItem(self.name, self.metrics)
+
+        return False
+
+
+class BuildReport:
+    """
+    Collects the metrics of the stages of the build and their items
+    """
+    def __init__(self, path):
+        self.path = path
+        self.stages = []
+        self.currentStage = None
+
+        self.total = Measurement().__enter__()
+        self.total.workerMetrics = {}
+
+    def save(self):
+        self.total.__exit__(None, None, None)
+        mergeMetrics(self.total.metrics, [self.total.workerMetrics])
+        del self.total.metrics["RSSGrowth"]
+
+        report = {
+            "Version": globals.version,
+            "Python": platform.python_version(),
+            "Platform": platform.platform(),
+            "Jobs": globals.jobs,
+            "Incremental": globals.incremental,
+            "Preset": globals.preset,
+            "TraceMalloc": tracemalloc.is_tracing(),
+            "Total": self.total.metrics,
+            "Stages": self.stages,
+        }
+
+        with open(self.path + '.tmp', "w", encoding='utf-8') as out:
+            json.dump(report, out, indent=1)
+
+        os.replace(self.path + '.tmp', self.path)
+
+
+def measureStage(name):
+    """
+    Measure a step of the build
+    """
+    return Stage(globals.report, name)
+
+
+def measureItem(name):
+    """
+    Measure an item of the current step, in this process
+    """
+    return Item(name)
+
+
+@contextmanager
+def collectItems():
+    """
+    Collect the items measured by a job running in a worker process
+    """
+    global _jobItems
+
+    _jobItems = items = []
+    try:
+        yield items
+
+    finally:
+        _jobItems = None
+
+
+def addItem(name, metrics, stage=None):
+    """
+    Add the metrics of an item to the current step,
+    which may have been measured in a worker process.
+    stage is the step the item belongs to, if several run at once.
+    """
+    if metrics is None:
+        return
+
+    item = {"Name": name}
+    if stage:
+        item["Stage"] = stage
+
+    item.update(metrics)
+    jobItems = item.pop("Items", [])
+
+    if globals.report is None:
+        if _jobItems is not None:
+            _jobItems.append(item)
+
+        return
+
+    if globals.report.currentStage is None:
+        return
+
+    globals.report.currentStage.items.append(item)
+
+    for jobItem in jobItems:
+        jobItem = dict(jobItem, Job=name)
+        if stage:
+            jobItem.setdefault("Stage", stage)
+
+        globals.report.currentStage.items.append(jobItem)
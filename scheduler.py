@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""scheduler.py: Runs a graph of build tasks on a shared pool of worker processes."""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from workers import getWorkerState, initWorker, runCaptured, runMeasured
+
+
+class Task:
+    """
+    A call of func(item) that can start once all the tasks in deps are done.
+    weight is the estimated time the task takes, relative to the other tasks,
+    and cost the estimated memory it needs.
+    """
+    def __init__(self, name, func, item, deps=(), weight=1, cost=0, group=''):
+        self.name = name
+        self.func = func
+        self.item = item
+        self.deps = list(deps)
+        self.weight = weight
+        self.cost = cost
+        self.group = group
+
+        self.dependents = []
+        self.priority = 0
+
+
+class Scheduler:
+    """
+    Runs the tasks in an order that respects their dependencies. The ready
+    task on the longest remaining path through the graph starts first, so
+    that the build takes about as long as its critical path.
+    """
+    def __init__(self, jobs=1, budget=0):
+        self.jobs = jobs
+        self.budget = budget
+        self.tasks = []
+
+    def add(self, name, func, item, deps=(), weight=1, cost=0, group=''):
+        """
+        Add a task, whose dependencies must have been added before it
+        """
+        task = Task(name, func, item, deps, weight, cost, group)
+
+        for dep in task.deps:
+            dep.dependents.append(task)
+
+        self.tasks.append(task)
+        return task
+
+    def computePriorities(self):
+        # The tasks were added after their dependencies,
+        # so their dependents are always handled first here
+        for task in reversed(self.tasks):
+            task.priority = task.weight + max((dependent.priority for dependent in task.dependents), default=0)
+
+    def nextTask(self, ready, pending, inUse):
+        """
+        Take the ready task with the highest priority that fits in the
+        memory budget, always allowing one so that big tasks can't block
+        """
+        for i in range(len(ready) - 1, -1, -1):
+            if not self.budget or not pending or inUse + ready[i].cost <= self.budget:
+                return ready.pop(i)
+
+        return None
+
+    def run(self):
+        """
+        Run all the tasks, yielding (task, result, output, error, metrics)
+        as they finish. If jobs < 2, the tasks run in this process.
+        """
+        self.computePriorities()
+
+        waiting = {task: len(task.deps) for task in self.tasks}
+        ready = [task for task in self.tasks if not task.deps]
+
+        if self.jobs < 2 or len(self.tasks) < 2:
+            while ready:
+                ready.sort(key=lambda task: task.priority)
+                task = ready.pop()
+
+                # Let the output go straight to the console
+                result, error, metrics = runMeasured(task.func, task.item)
+
+                for dependent in task.dependents:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+
+                yield task, result, '', error, metrics
+
+            return
+
+        jobs = min(self.jobs, len(self.tasks))
+
+        with ProcessPoolExecutor(jobs, initializer=initWorker, initargs=(getWorkerState(),)) as executor:
+            pending = {}
+            inUse = 0
+
+            while ready or pending:
+                ready.sort(key=lambda task: task.priority)
+
+                while ready and len(pending) < jobs:
+                    task = self.nextTask(ready, pending, inUse)
+                    if task is None:
+                        break
+
+                    pending[executor.submit(runCaptured, task.func, task.item)] = task
+                    inUse += task.cost
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    inUse -= task.cost
+
+                    result, output, error, metrics = future.result()
+
+                    # A failed task doesn't stop its dependents,
+                    # they have to handle what's missing themselves
+                    for dependent in task.dependents:
+                        waiting[dependent] -= 1
+                        if not waiting[dependent]:
+                            ready.append(dependent)
+
+                    yield task, result, output, error, metrics
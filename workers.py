@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+from contextlib import redirect_stdout
+import io
+import traceback
+import tracemalloc
+
+from cache import spriteCache, tilesetCache
+import globals
+from report import Measurement, collectItems
+
+# The globals a worker process needs to know about
+WorkerState = (
+    'curr_path',
+    'gamepath',
+    'mod_path',
+    'patchpath',
+    'cachepath',
+    'incremental',
+    'preset',
+    'szs_cache_size',
+    'compression_queue',
+    'tileset_cache_size',
+    'sprite_cache_size',
+    'manifest',
+    'dependencies',
+    'trace_malloc',
+)
+
+
+def getWorkerState():
+    """
+    Get the state that has to be passed to the worker processes
+    """
+    return {name: getattr(globals, name) for name in WorkerState}
+
+
+def initWorker(state):
+    """
+    Set up the globals of a worker process
+    """
+    for name in state:
+        setattr(globals, name, state[name])
+
+    # Only the main process writes the report,
+    # the workers send their metrics back with their results
+    globals.report = None
+
+    tilesetCache.setBudget(globals.tileset_cache_size)
+    spriteCache.setBudget(globals.sprite_cache_size)
+
+    if globals.trace_malloc:
+        tracemalloc.start()
+
+
+def runCaptured(func, item):
+    """
+    Run a job, capturing everything it prints
+    """
+    out = io.StringIO()
+    with redirect_stdout(out), collectItems() as items:
+        result, error, metrics = runMeasured(func, item)
+
+    if items:
+        metrics["Items"] = items
+
+    return result, out.getvalue(), error, metrics
+
+
+def runMeasured(func, item):
+    """
+    Run a job, measuring it for the build report
+    """
+    with Measurement() as measurement:
+        try:
+            result = func(item)
+
+        except Exception:
+            result = None
+            error = traceback.format_exc()
+
+        else:
+            error = None
+
+    return result, error, measurement.metrics
+
+
+def runJobs(func, items):
+    """
+    Run func on every item in this process, yielding
+    (item, result, output, error, metrics) in the same order as items.
+    With several jobs, the build goes through the scheduler instead.
+    """
+    for item in items:
+        # Let the output go straight to the console
+        result, error, metrics = runMeasured(func, item)
+        yield item, result, '', error, metrics
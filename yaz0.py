@@ -21,11 +21,15 @@
 ################################################################
 ################################################################
 
+import asyncio
+import math
 import os
 import platform
-import subprocess
+import shutil
+import tempfile
 
 import globals
+import yaz0_builtin
 
 if globals.cython_available:
     try:
@@ -39,100 +43,274 @@ if globals.cython_available:
         globals.libyaz0_available = True
 
 
+# Compression presets -> level, from 0 (store) to 9 (best),
+# which means the same on every backend
+Presets = {
+    "fast": 1,
+    "balanced": 6,
+    "max": 9,
+}
+
+# The most files handed to one WSZST invocation,
+# which keeps its command line short enough for Windows
+WSZSTBatchSize = 64
+
+# Without libyaz0, files at least this big are compressed by WSZST
+WSZSTMinSize = 0x10000
+
+
+def useWSZST(size):
+    """
+    Check if data of the given size should be compressed by WSZST.
+    Without libyaz0, the built-in compressor is used for small files,
+    where starting WSZST would cost more than compressing them.
+    """
+    return not globals.libyaz0_available and size >= WSZSTMinSize and os.path.isfile(getWSZSTPath())
+
+
 def determineCompressionMethod():
     if globals.libyaz0_available:
         return compressLIBYAZ0, decompressLIBYAZ0
 
     else:
-        return compressWSZST, decompressWSZST
+        return compressBUILTIN, decompressBUILTIN
 
 
-def compressWSZST(inf, outf, level=9):
+def writeCompressed(outf, chunks):
     """
-    Compress the file using WSZST
+    Write the compressed chunks to outf as they are produced,
+    removing what was written if compression fails
     """
-    if os.path.isfile(outf):
-        os.remove(outf)
+    try:
+        with open(outf, "wb+") as out:
+            for chunk in chunks:
+                out.write(chunk)
 
+    except:
+        if os.path.isfile(outf):
+            os.remove(outf)
+
+        return False
+
+    else:
+        return True
+
+
+def getWSZSTPath():
+    """
+    Get the path of the WSZST executable for this platform
+    """
     if platform.system() == 'Windows':
-        os.chdir(globals.curr_path + '/Tools')
-        subprocess.call('wszst.exe COMPRESS "' + inf + '" --dest "' + outf + '"', creationflags=0x8)
+        return os.path.join(globals.curr_path, 'Tools/wszst.exe')
 
     elif platform.system() == 'Linux':
-        os.chdir(globals.curr_path + '/linuxTools')
-        os.system('chmod +x ./wszst_linux.elf')
-        os.system('./wszst_linux.elf COMPRESS "' + inf + '" --dest "' + outf + '"')
+        path = os.path.join(globals.curr_path, 'linuxTools/wszst_linux.elf')
+        if os.path.isfile(path) and not os.access(path, os.X_OK):
+            os.chmod(path, os.stat(path).st_mode | 0o111)
+
+        return path
 
     else:
-        os.chdir(globals.curr_path + '/macTools')
-        os.system('"' + globals.curr_path + '/macTools/wszst_mac" COMPRESS "' + inf + '" --dest "' + outf + '"')
+        return os.path.join(globals.curr_path, 'macTools/wszst_mac')
 
-    os.chdir(globals.curr_path)
 
-    if not os.path.isfile(outf):
-        return False
+async def runWSZSTBatch(command, files, outputs, args, semaphore):
+    """
+    Run WSZST once on a batch of files, in a private temporary directory.
+    Each file is either data or the path of a file. Returns the data of
+    each output, True if it was moved to its path in outputs or False
+    if it wasn't created.
+    """
+    async with semaphore:
+        with tempfile.TemporaryDirectory(prefix='wszst') as tmp:
+            names = []
+            for i, inb in enumerate(files):
+                name = os.path.join(tmp, str(i))
 
-    return True
+                if isinstance(inb, str):
+                    shutil.copyfile(inb, name)
 
+                else:
+                    with open(name, "wb") as out:
+                        out.write(inb)
 
-def decompressWSZST(inb):
+                names.append(name)
+
+            kwargs = {}
+            if platform.system() == 'Windows':
+                kwargs['creationflags'] = 0x8
+
+            process = await asyncio.create_subprocess_exec(
+                getWSZSTPath(), command, *names, '--dest', os.path.join(tmp, '%N.out'), '--quiet', *args,
+                stdout=asyncio.subprocess.DEVNULL, **kwargs)
+
+            await process.wait()
+
+            results = []
+            for name, outf in zip(names, outputs):
+                try:
+                    if outf:
+                        shutil.move(name + '.out', outf)
+                        results.append(True)
+
+                    else:
+                        with open(name + '.out', "rb") as inf:
+                            results.append(inf.read())
+
+                except OSError:
+                    results.append(False)
+
+            return results
+
+
+def getWSZSTBatchSize(count, jobs):
     """
-    Deompress the data using WSZST
+    Get how many of count files go in each WSZST invocation,
+    so that there are at least jobs batches to run at once
+    (WSZST itself only uses one core)
     """
-    inf = os.path.join(globals.curr_path, 'tmp.tmp')
-    outf = os.path.join(globals.curr_path, 'tmp2.tmp')
+    return max(1, min(WSZSTBatchSize, math.ceil(count / max(1, jobs))))
 
-    with open(inf, "wb+") as out:
-        out.write(inb)
 
-    if os.path.isfile(outf):
-        os.remove(outf)
+async def runWSZSTBatches(command, files, outputs, args, jobs):
+    semaphore = asyncio.Semaphore(jobs)
+    size = getWSZSTBatchSize(len(files), jobs)
 
-    if platform.system() == 'Windows':
-        os.chdir(globals.curr_path + '/Tools')
-        subprocess.call('wszst.exe DECOMPRESS "' + inf + '" --dest "' + outf + '"', creationflags=0x8)
+    results = await asyncio.gather(*(
+        runWSZSTBatch(command, files[i:i + size], outputs[i:i + size], args, semaphore)
+        for i in range(0, len(files), size)
+    ))
 
-    elif platform.system() == 'Linux':
-        os.chdir(globals.curr_path + '/linuxTools')
-        os.system('chmod +x ./wszst_linux.elf')
-        os.system('./wszst_linux.elf DECOMPRESS "' + inf + '" --dest "' + outf + '"')
+    return [result for batch in results for result in batch]
 
-    else:
-        os.chdir(globals.curr_path + '/macTools')
-        os.system('"' + globals.curr_path + '/macTools/wszst_mac" DECOMPRESS "' + inf + '" --dest "' + outf + '"')
 
-    os.remove(inf)
-    os.chdir(globals.curr_path)
+def runWSZST(command, files, outputs=None, args=(), jobs=1):
+    """
+    Run a WSZST command on many files, in batches of up to WSZSTBatchSize
+    files with up to jobs batches running at once. The files are spread
+    over at least jobs batches when there are enough of them. Each file is either data
+    or the path of a file. The outputs are moved to the paths in outputs
+    where given. Returns the data of each output, True if it was moved or
+    False if it failed.
+    """
+    if not files:
+        return []
+
+    files = list(files)
+    outputs = list(outputs) if outputs else [None] * len(files)
+
+    return asyncio.run(runWSZSTBatches(command, files, outputs, list(args), max(1, jobs)))
+
 
-    if not os.path.isfile(outf):
-        return b''
+class WSZSTBatch:
+    """
+    Queues files to be compressed by WSZST,
+    so that they are handed to as few invocations as possible
+    """
+    def __init__(self, level=9):
+        self.level = level
+        self.files = []
+        self.outputs = []
+
+    def add(self, inb, outf=None):
+        """
+        Queue the data, to be written to outf if given
+        """
+        self.files.append(inb)
+        self.outputs.append(outf)
+
+    def addFile(self, inf, outf=None):
+        """
+        Queue the file at the path inf, to be written to outf if given
+        """
+        self.files.append(inf)
+        self.outputs.append(outf)
+
+    def run(self, jobs=1):
+        """
+        Compress the queued files. Returns the compressed data of each,
+        True if it was written to its outf or False if it failed.
+        """
+        results = runWSZST('COMPRESS', self.files, self.outputs, ('--compr', str(self.level)), jobs)
+
+        self.files = []
+        self.outputs = []
+
+        return results
+
+
+def compressWSZST(inb, level=9, outf=None):
+    """
+    Compress the data using WSZST.
+    Returns the compressed data, or writes it to outf if given.
+    """
+    batch = WSZSTBatch(level)
+    batch.add(inb, outf)
 
-    with open(outf, "rb") as inf_:
-        data = inf_.read()
+    return batch.run()[0]
 
-    os.remove(outf)
 
-    return data
+def decompressWSZSTBatch(files, jobs=1):
+    """
+    Decompress the data of many files using WSZST
+    """
+    return [b'' if data is False else data for data in runWSZST('DECOMPRESS', files, jobs=jobs)]
 
 
-def compressLIBYAZ0(inf, outf, level=1):
+def decompressWSZST(inb):
     """
-    Compress the file using libyaz0
+    Deompress the data using WSZST
     """
-    with open(inf, "rb") as inf_:
-        inb = inf_.read()
+    return decompressWSZSTBatch([inb])[0]
+
 
+def compressLIBYAZ0(inb, level=1, outf=None):
+    """
+    Compress the data using libyaz0.
+    Returns the compressed data, or writes it to outf if given.
+    """
     try:
         data = compress(inb, 0, level)
 
-        with open(outf, "wb+") as out:
-            out.write(data)
+    except:
+        return False
+
+    if outf:
+        return writeCompressed(outf, (data,))
+
+    return data
+
+
+def compressBUILTIN(inb, level=1, outf=None):
+    """
+    Compress the data using the built-in compressor.
+    Returns the compressed data, or streams it into outf if given.
+    """
+    if outf:
+        return writeCompressed(outf, yaz0_builtin.iterCompress(inb, level))
+
+    try:
+        data = yaz0_builtin.compress(inb, level)
 
     except:
         return False
 
     else:
-        return True
+        return data
+
+
+def decompressBUILTIN(inb):
+    """
+    Decompress the data using the built-in decompressor
+    """
+    try:
+        data = yaz0_builtin.decompress(inb)
+
+    except:
+        return False
+
+    else:
+        return data
 
 
 def decompressLIBYAZ0(inb):
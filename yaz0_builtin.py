@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# OtherSMBU Patcher
+# Version 0.1
+# Copyright © 2018 AboodXD
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################
+################################################################
+
+"""yaz0_builtin.py: Yaz0 compressor and decompressor with no external dependencies."""
+
+import struct
+
+MinMatch = 3
+MaxMatch = 0x111
+WindowSize = 0x1000
+
+# Compression level: (max chain length, nice match length, lazy matching)
+# Level 0 stores the data without looking for matches.
+Levels = [
+    (0, 0, False),
+    (4, 16, False),
+    (8, 32, False),
+    (16, 64, False),
+    (32, 96, False),
+    (64, 128, True),
+    (128, 160, True),
+    (256, 192, True),
+    (1024, MaxMatch, True),
+    (WindowSize, MaxMatch, True),
+]
+
+
+def compress(src, level=1, alignment=0):
+    """
+    Compress the data using a hash chain match finder
+    """
+    return b''.join(iterCompress(src, level, alignment))
+
+
+def iterCompress(src, level=1, alignment=0, chunkSize=0x10000):
+    """
+    Compress the data incrementally, yielding chunks of about chunkSize bytes,
+    so that the result can be written out while it's being compressed
+    """
+    src = bytes(src)
+    srcEnd = len(src)
+
+    dest = bytearray(b'Yaz0')
+    dest += struct.pack('>3I', srcEnd, alignment, 0)
+
+    maxChain, niceLen, lazy = Levels[max(0, min(level, len(Levels) - 1))]
+
+    if not maxChain:
+        # Every chunk is a literal
+        for pos in range(0, srcEnd, 8):
+            chunk = src[pos:pos + 8]
+            dest.append((0xFF00 >> len(chunk)) & 0xFF)
+            dest += chunk
+
+            if len(dest) >= chunkSize:
+                yield bytes(dest)
+                dest.clear()
+
+        if dest:
+            yield bytes(dest)
+
+        return
+
+    # head: the last position where each 3-byte string was seen
+    # prev: the previous position with the same 3-byte string
+    head = {}
+    prev = [-1] * srcEnd
+    inserted = 0
+
+    def longestMatch(pos):
+        nonlocal inserted
+
+        # Add every position before this one to the hash chains
+        while inserted < pos:
+            key = src[inserted:inserted + MinMatch]
+            prev[inserted] = head.get(key, -1)
+            head[key] = inserted
+            inserted += 1
+
+        maxLen = min(MaxMatch, srcEnd - pos)
+        if maxLen < MinMatch:
+            return 0, 0
+
+        bestLen = MinMatch - 1
+        bestPos = 0
+        goodLen = min(niceLen, maxLen)
+
+        windowStart = max(0, pos - WindowSize)
+        candidate = head.get(src[pos:pos + MinMatch], -1)
+        chain = maxChain
+
+        while candidate >= windowStart and chain:
+            # Quick reject: it can only be better if it matches one byte further
+            if src[candidate + bestLen] == src[pos + bestLen]:
+                length = MinMatch
+                while length + 8 <= maxLen and src[candidate + length:candidate + length + 8] == src[pos + length:pos + length + 8]:
+                    length += 8
+
+                while length < maxLen and src[candidate + length] == src[pos + length]:
+                    length += 1
+
+                if length > bestLen:
+                    bestLen = length
+                    bestPos = candidate
+
+                    if length >= goodLen:
+                        break
+
+            candidate = prev[candidate]
+            chain -= 1
+
+        if bestLen < MinMatch:
+            return 0, 0
+
+        return bestLen, pos - bestPos
+
+    pos = 0
+    pending = None
+
+    while pos < srcEnd:
+        flagPos = len(dest)
+        dest.append(0)
+        flag = 0
+
+        for bit in range(8):
+            if pos >= srcEnd:
+                break
+
+            if pending is not None and pending[0] == pos:
+                _, length, dist = pending
+
+            else:
+                length, dist = longestMatch(pos)
+
+            pending = None
+
+            if lazy and MinMatch <= length < niceLen and pos + 1 < srcEnd:
+                # Emit a literal instead if the next position has a longer match
+                nextLength, nextDist = longestMatch(pos + 1)
+                pending = (pos + 1, nextLength, nextDist)
+
+                if nextLength > length:
+                    length = 0
+
+            if length < MinMatch:
+                flag |= 0x80 >> bit
+                dest.append(src[pos])
+                pos += 1
+
+            else:
+                dist -= 1
+
+                if length < 0x12:
+                    dest.append((length - 2) << 4 | dist >> 8)
+                    dest.append(dist & 0xFF)
+
+                else:
+                    dest.append(dist >> 8)
+                    dest.append(dist & 0xFF)
+                    dest.append(length - 0x12)
+
+                pos += length
+
+        dest[flagPos] = flag
+
+        # A group is only complete once its flag byte is set
+        if len(dest) >= chunkSize:
+            yield bytes(dest)
+            dest.clear()
+
+    if dest:
+        yield bytes(dest)
+
+
+# Enough compressed data for one flag byte and 8 back-references
+MaxGroupSize = 1 + 8 * 3
+ReadSize = 0x10000
+
+
+def iterDecompress(src, chunkSize=0x10000):
+    """
+    Decompress the data incrementally, yielding chunks of about chunkSize bytes.
+    src can either be a bytes-like object or a file opened in binary mode.
+    """
+    if hasattr(src, 'read'):
+        read = src.read
+        buf = read(ReadSize)
+
+    else:
+        read = None
+        buf = src
+
+    if len(buf) < 16 or buf[:4] != b'Yaz0':
+        raise ValueError("Not a Yaz0 compressed file!")
+
+    destEnd = struct.unpack_from('>I', buf, 4)[0]
+    done = 0
+    srcPos = 16
+
+    # Only the last WindowSize bytes are needed for back-references
+    out = bytearray()
+
+    while done < destEnd:
+        if read is not None and len(buf) - srcPos < MaxGroupSize:
+            more = read(ReadSize)
+            if more:
+                buf = buf[srcPos:] + more
+                srcPos = 0
+
+        code = buf[srcPos]
+        srcPos += 1
+
+        for _ in range(8):
+            if done >= destEnd:
+                break
+
+            if code & 0x80:
+                out.append(buf[srcPos])
+                srcPos += 1
+                done += 1
+
+            else:
+                b1 = buf[srcPos]
+                b2 = buf[srcPos + 1]
+                srcPos += 2
+
+                dist = ((b1 & 0xF) << 8 | b2) + 1
+
+                n = b1 >> 4
+                if not n:
+                    n = buf[srcPos] + 0x12
+                    srcPos += 1
+
+                else:
+                    n += 2
+
+                n = min(n, destEnd - done)
+                copySrc = len(out) - dist
+
+                if copySrc < 0:
+                    raise ValueError("Invalid back-reference in Yaz0 data!")
+
+                if dist >= n:
+                    out += out[copySrc:copySrc + n]
+
+                else:
+                    # The copy overlaps itself, so repeat the pattern
+                    out += (out[copySrc:] * (n // dist + 1))[:n]
+
+                done += n
+
+            code <<= 1
+
+        if len(out) >= chunkSize + WindowSize:
+            cut = len(out) - WindowSize
+            yield bytes(out[:cut])
+            del out[:cut]
+
+    if out:
+        yield bytes(out)
+
+
+def decompress(src):
+    """
+    Decompress the data into a buffer preallocated from the size in the header,
+    copying the back-references from that buffer
+    """
+    if hasattr(src, 'read'):
+        src = src.read()
+
+    if len(src) < 16 or src[:4] != b'Yaz0':
+        raise ValueError("Not a Yaz0 compressed file!")
+
+    destEnd = struct.unpack_from('>I', src, 4)[0]
+    dest = bytearray(destEnd)
+    destPos = 0
+    srcPos = 16
+
+    while destPos < destEnd:
+        code = src[srcPos]
+        srcPos += 1
+
+        for _ in range(8):
+            if destPos >= destEnd:
+                break
+
+            if code & 0x80:
+                dest[destPos] = src[srcPos]
+                srcPos += 1
+                destPos += 1
+
+            else:
+                b1 = src[srcPos]
+                b2 = src[srcPos + 1]
+                srcPos += 2
+
+                dist = ((b1 & 0xF) << 8 | b2) + 1
+
+                n = b1 >> 4
+                if not n:
+                    n = src[srcPos] + 0x12
+                    srcPos += 1
+
+                else:
+                    n += 2
+
+                n = min(n, destEnd - destPos)
+                copySrc = destPos - dist
+
+                if copySrc < 0:
+                    raise ValueError("Invalid back-reference in Yaz0 data!")
+
+                if dist >= n:
+                    dest[destPos:destPos + n] = dest[copySrc:copySrc + n]
+
+                else:
+                    # The copy overlaps itself, so repeat the pattern
+                    dest[destPos:destPos + n] = (dest[copySrc:destPos] * (n // dist + 1))[:n]
+
+                destPos += n
+
+            code <<= 1
+
+    return dest